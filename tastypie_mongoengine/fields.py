@@ -1,6 +1,11 @@
 import tastypie
 from tastypie import bundle as tastypie_bundle, exceptions, fields
 
+import bson
+
+import mongoengine
+from mongoengine import base as mongoengine_base
+
 
 def link_property(property_name):
     def getter(self):
@@ -12,6 +17,16 @@ def link_property(property_name):
     return property(getter, setter)
 
 
+def document_stub(document_class, pk):
+    """
+    Returns a document of the given class with only the primary key set.
+    """
+
+    obj = document_class._from_son({'_id': pk})
+    obj._is_stub = True
+    return obj
+
+
 class ObjectId(fields.ApiField):
     """
     Field for representing ObjectId from MongoDB.
@@ -31,10 +46,13 @@ class ApiNameMixin(object):
 
 
 class GetRelatedMixin(object):
+    def _prefers_polymorphic_resource_uri(self, related_resource):
+        return bool(getattr(related_resource._meta, 'polymorphic', {})) and getattr(related_resource._meta, 'prefer_polymorphic_resource_uri', False)
+
     def get_related_resource(self, related_instance):
         related_resource = super(GetRelatedMixin, self).get_related_resource(related_instance)
         type_map = getattr(related_resource._meta, 'polymorphic', {})
-        if type_map and getattr(related_resource._meta, 'prefer_polymorphic_resource_uri', False):
+        if self._prefers_polymorphic_resource_uri(related_resource):
             resource = related_resource._get_resource_from_class(type_map, related_instance.__class__)
             if related_resource.get_resource_uri():
                 related_resource._meta.resource_name = resource._meta.resource_name
@@ -45,6 +63,102 @@ class TastypieMongoengineMixin(ApiNameMixin, GetRelatedMixin):
     pass
 
 
+class ReferenceMixin(TastypieMongoengineMixin):
+    def resource_from_uri(self, fk_resource, uri, request=None, related_obj=None, related_name=None):
+        if not hasattr(fk_resource, 'get_via_uris'):
+            return super(ReferenceMixin, self).resource_from_uri(fk_resource, uri, request, related_obj, related_name)
+        return self.resources_from_uris(fk_resource, [uri], request)[uri]
+
+    def _check_trust_uris(self):
+        # Trusted URIs give only primary keys, there is no document to show in full
+        if self.trust_uris and self.full:
+            raise ValueError("Field cannot have both 'trust_uris' and 'full' set.")
+
+    def resources_from_uris(self, fk_resource, uris, request=None):
+        """
+        A version of ``resource_from_uri`` which loads objects of all given URIs
+        at once. If ``trust_uris`` is set, referenced documents are not loaded
+        and bundles contain only documents with the primary key from the URI.
+        URIs are resolved together only within one field.
+
+        Returns a dictionary mapping URIs to bundles.
+        """
+
+        objs = fk_resource.get_via_uris(uris, request=request, trust=self.trust_uris)
+
+        bundles = {}
+        for uri in uris:
+            if uri in bundles:
+                continue
+            if uri not in objs:
+                raise exceptions.ApiFieldError("Could not find the provided object via resource URI '%s'." % uri)
+            fk_bundle = fk_resource.build_bundle(obj=objs[uri], request=request)
+            if self.trust_uris:
+                # There is no data to dehydrate
+                bundles[uri] = fk_bundle
+            else:
+                bundles[uri] = fk_resource.full_dehydrate(fk_bundle)
+        return bundles
+
+    def get_reference_stubs(self, field, values):
+        """
+        Returns documents with only the primary key set for references as stored
+        in the document by the given field, so that resource URIs can be built
+        without loading referenced documents. Already loaded documents are
+        returned as they are.
+
+        Returns ``None`` if this is not possible (if the class of a referenced
+        document is needed for a polymorphic resource URI but it is not stored
+        with the reference, or if resource URIs do not use the primary key,
+        for example).
+        """
+
+        if isinstance(field, mongoengine.ReferenceField):
+            document_type = field.document_type
+        elif isinstance(field, mongoengine.GenericReferenceField):
+            document_type = None
+        else:
+            return None
+
+        resource = self.to_class(self.get_api_name())
+        resource_classes = [type(resource)] + list(getattr(resource._meta, 'polymorphic', {}).values())
+        if any(getattr(resource_class._meta, 'detail_uri_name', 'pk') != 'pk' for resource_class in resource_classes):
+            return None
+
+        if document_type is not None and self._prefers_polymorphic_resource_uri(resource):
+            # Only generic references store the class of the referenced document
+            document_type = None
+
+        stubs = []
+        for value in values:
+            if isinstance(value, mongoengine.Document):
+                stubs.append(value)
+                continue
+
+            document_class = document_type
+            if isinstance(value, dict) and '_ref' in value:
+                try:
+                    document_class = mongoengine_base.get_document(value.get('_cls'))
+                except mongoengine.NotRegistered:
+                    return None
+                value = value['_ref']
+
+            if document_class is None:
+                return None
+
+            if isinstance(value, bson.DBRef):
+                if value.collection != document_class._get_collection_name():
+                    return None
+                value = value.id
+
+            if value is None:
+                return None
+
+            stubs.append(document_stub(document_class, value))
+
+        return stubs
+
+
 class BuildRelatedMixin(TastypieMongoengineMixin):
     def build_related_resource(self, value, **kwargs):
         # A version of build_related_resource which allows only dictionary-like data
@@ -61,7 +175,7 @@ class BuildRelatedMixin(TastypieMongoengineMixin):
             raise exceptions.ApiFieldError("The '%s' field was not given a dictionary-alike data: %s." % (self.instance_name, value))
 
 
-class ReferenceField(TastypieMongoengineMixin, fields.ToOneField):
+class ReferenceField(ReferenceMixin, fields.ToOneField):
     """
     References another MongoEngine document.
     """
@@ -70,10 +184,12 @@ class ReferenceField(TastypieMongoengineMixin, fields.ToOneField):
 
     def __init__(self, *args, **kwargs):
         help_text = kwargs.pop('help_text', None)
+        self.trust_uris = kwargs.pop('trust_uris', False)
 
         super(ReferenceField, self).__init__(*args, **kwargs)
 
         self._help_text = help_text
+        self._check_trust_uris()
 
     @property
     def help_text(self):
@@ -91,6 +207,27 @@ class ReferenceField(TastypieMongoengineMixin, fields.ToOneField):
             }),
         }
 
+    def dehydrate(self, bundle, for_list=True):
+        # Only resource URI is needed when not full, so we build it
+        # from the stored reference without loading the document
+        if not self.full and bundle.obj and isinstance(self.attribute, basestring):
+            value = getattr(bundle.obj, '_data', {}).get(self.attribute)
+            stubs = None
+            if value is not None:
+                stubs = self.get_reference_stubs(getattr(bundle.obj, '_fields', {}).get(self.attribute), [value])
+            if stubs is not None:
+                self.fk_resource = self.get_related_resource(stubs[0])
+                fk_bundle = tastypie_bundle.Bundle(obj=stubs[0], request=bundle.request)
+                if tastypie.__version__ >= (0, 9, 15):
+                    return self.dehydrate_related(fk_bundle, self.fk_resource, for_list=for_list)
+                else:
+                    return self.dehydrate_related(fk_bundle, self.fk_resource)
+
+        if tastypie.__version__ >= (0, 9, 15):
+            return super(ReferenceField, self).dehydrate(bundle, for_list=for_list)
+        else:
+            return super(ReferenceField, self).dehydrate(bundle)
+
 
 class EmbeddedDocumentField(BuildRelatedMixin, fields.ToOneField):
     """
@@ -236,7 +373,7 @@ class EmbeddedListField(BuildRelatedMixin, fields.ToManyField):
         return self._to_class_with_listresource
 
 
-class ReferencedListField(TastypieMongoengineMixin, fields.ToManyField):
+class ReferencedListField(ReferenceMixin, fields.ToManyField):
     """
     Represents a list of referenced objects. It must be used in conjunction
     with ReferenceField.
@@ -244,10 +381,12 @@ class ReferencedListField(TastypieMongoengineMixin, fields.ToManyField):
 
     def __init__(self, of, attribute, **kwargs):
         help_text = kwargs.pop('help_text', None)
+        self.trust_uris = kwargs.pop('trust_uris', False)
 
         super(ReferencedListField, self).__init__(to=of, attribute=attribute, **kwargs)
 
         self._help_text = help_text
+        self._check_trust_uris()
 
     @property
     def help_text(self):
@@ -276,7 +415,15 @@ class ReferencedListField(TastypieMongoengineMixin, fields.ToManyField):
         the_m2ms = None
 
         if isinstance(self.attribute, basestring):
-            the_m2ms = getattr(bundle.obj, self.attribute)
+            if not self.full:
+                # Only resource URIs are needed, so we do not load documents
+                values = getattr(bundle.obj, '_data', {}).get(self.attribute)
+                if values is not None:
+                    the_m2ms = self.get_reference_stubs(getattr(getattr(bundle.obj, '_fields', {}).get(self.attribute), 'field', None), values)
+            if the_m2ms is None:
+                the_m2ms = self.get_referenced_documents(bundle.obj)
+            if the_m2ms is None:
+                the_m2ms = getattr(bundle.obj, self.attribute)
         elif callable(self.attribute):
             the_m2ms = self.attribute(bundle)
 
@@ -287,10 +434,20 @@ class ReferencedListField(TastypieMongoengineMixin, fields.ToManyField):
 
         self.m2m_resources = []
         m2m_dehydrated = []
+        related_resources = {}
 
         # the_m2ms is a list, not a queryset
         for m2m in the_m2ms:
-            m2m_resource = self.get_related_resource(m2m)
+            # One resource is enough for all documents of the same class, but
+            # not for polymorphic resource URIs, as get_related_resource sets
+            # resource name in shared resource options for each document
+            m2m_resource = related_resources.get(m2m.__class__)
+            if m2m_resource is None:
+                m2m_resource = self.get_related_resource(m2m)
+                if not self._prefers_polymorphic_resource_uri(m2m_resource):
+                    related_resources[m2m.__class__] = m2m_resource
+            else:
+                m2m_resource.instance = m2m
             m2m_bundle = tastypie_bundle.Bundle(obj=m2m, request=bundle.request)
             self.m2m_resources.append(m2m_resource)
             if tastypie.__version__ >= (0, 9, 15):
@@ -300,6 +457,66 @@ class ReferencedListField(TastypieMongoengineMixin, fields.ToManyField):
 
         return m2m_dehydrated
 
+    def hydrate_m2m(self, bundle):
+        values = bundle.data.get(self.instance_name)
+        if self.readonly or not values:
+            return super(ReferencedListField, self).hydrate_m2m(bundle)
+
+        # All URIs are resolved together
+        fk_resource = self.to_class(self.get_api_name())
+        uris = [value for value in values if isinstance(value, basestring)]
+        if not uris or not hasattr(fk_resource, 'get_via_uris'):
+            return super(ReferencedListField, self).hydrate_m2m(bundle)
+        bundles = self.resources_from_uris(fk_resource, uris, bundle.request)
+
+        kwargs = {
+            'request': bundle.request,
+        }
+
+        if self.related_name:
+            kwargs['related_obj'] = bundle.obj
+            kwargs['related_name'] = self.related_name
+
+        m2m_hydrated = []
+        for value in values:
+            if value is None:
+                continue
+            elif isinstance(value, basestring):
+                m2m_hydrated.append(bundles[value])
+            else:
+                m2m_hydrated.append(self.build_related_resource(value, **kwargs))
+
+        return m2m_hydrated
+
+    def get_referenced_documents(self, obj):
+        """
+        Returns documents referenced by the list in the document, in order, loaded
+        with one query. Documents which do not exist anymore are skipped.
+
+        Returns ``None`` if references cannot be loaded in this way (if they are
+        not all references to the document class of the list, for example).
+        """
+
+        field = getattr(obj, '_fields', {}).get(self.attribute)
+        document_type = getattr(getattr(field, 'field', None), 'document_type', None)
+        values = getattr(obj, '_data', {}).get(self.attribute)
+        if document_type is None or values is None:
+            return None
+
+        collection_name = document_type._get_collection_name()
+        ids = []
+        for value in values:
+            if isinstance(value, bson.DBRef):
+                if value.collection != collection_name:
+                    return None
+                ids.append(value.id)
+            elif not isinstance(value, mongoengine.Document):
+                return None
+
+        documents = document_type.objects.in_bulk(ids) if ids else {}
+
+        return [documents[value.id] if isinstance(value, bson.DBRef) else value for value in values if not isinstance(value, bson.DBRef) or value.id in documents]
+
     def resource_from_data(self, fk_resource, data, request=None, related_obj=None, related_name=None):
         # We are ignoring any extra fields not present in resource
         # We delete them because otherwise resource_from_data fail
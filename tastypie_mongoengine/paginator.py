@@ -1,19 +1,137 @@
+import hashlib
 import itertools
+import uuid
 
 from django.conf import settings
+from django.core import cache, exceptions as django_exceptions, signing
 
 from tastypie import exceptions, paginator
 
 import bson
-from bson import errors
+from bson import errors, json_util, son
+
+BOOKMARKS_GENERATION_KEY = 'tastypie_mongoengine.paginator.bookmarks:%s'
+BOOKMARKS_KEY = 'tastypie_mongoengine.paginator.bookmarks:%s:%s:%s'
+
+
+def _get_bookmarks_generation(collection_name):
+    key = BOOKMARKS_GENERATION_KEY % collection_name
+    generation = cache.cache.get(key)
+    if generation is None:
+        cache.cache.add(key, uuid.uuid4().hex, None)
+        generation = cache.cache.get(key)
+    return generation
+
+
+def invalidate_bookmarks(document_class):
+    """
+    Invalidates all offset bookmarks for the collection of the given document class.
+
+    Resources call this on writes when their paginator uses bookmarks, but if
+    documents are changed outside of the API, you have to call it yourself.
+    """
+
+    cache.cache.set(BOOKMARKS_GENERATION_KEY % document_class._get_collection_name(), uuid.uuid4().hex, None)
+
+
+class CursorSerializer(object):
+    """
+    Serializer for ``django.core.signing`` which supports MongoDB types
+    (ObjectId, dates, ...) found among values of ordering fields.
+    """
+
+    def dumps(self, obj):
+        return json_util.dumps(obj, separators=(',', ':'))
+
+    def loads(self, data):
+        return json_util.loads(data)
+
+
+class Cursor(object):
+    """
+    Position in a list of objects, given by values of all ordering fields
+    (with ObjectId as a tiebreaker) of an object at that position.
+
+    Cursor points between objects, so objects are returned strictly after
+    (or strictly before, if direction is negative) the object.
+
+    It is passed to and from clients as an opaque signed token.
+    """
+
+    salt = 'tastypie_mongoengine.paginator.Cursor'
+
+    def __init__(self, ordering, values, direction=1, token=None):
+        self.ordering = [(key, order) for key, order in ordering]
+        self.values = list(values)
+        self.direction = direction
+        self._token = token
+
+    @classmethod
+    def from_token(cls, token):
+        try:
+            data = signing.loads(token, salt=cls.salt, serializer=CursorSerializer)
+            cursor = cls(data['o'], data['v'], data['d'], token)
+        except (signing.BadSignature, KeyError, TypeError, ValueError):
+            raise ValueError("Invalid cursor '%s'." % token)
+
+        if len(cursor.ordering) != len(cursor.values) or cursor.direction not in (1, -1):
+            raise ValueError("Invalid cursor '%s'." % token)
+
+        return cursor
+
+    @property
+    def token(self):
+        if self._token is None:
+            self._token = signing.dumps({'o': self.ordering, 'v': self.values, 'd': self.direction}, salt=self.salt, serializer=CursorSerializer, compress=True)
+        return self._token
+
+    def __unicode__(self):
+        return unicode(self.token)
+
+    def __str__(self):
+        return str(self.token)
 
 
 class Paginator(paginator.Paginator):
     """
     Paginator which allows using MongoDB ObjectId as position
     from where to paginate (in positive or negative direction).
+
+    It also generates next and previous links for ObjectId-based
+    positions as opaque cursors which encode values of ordering fields,
+    so that following them costs the same no matter how deep they are.
+
+    How ``total_count`` is computed can be configured by subclassing and
+    setting ``count_strategy`` to one of:
+
+    * ``exact``: counts all matching objects (default)
+    * ``estimated``: uses collection metadata when the queryset is not filtered, otherwise counts exactly
+    * ``capped``: counts matching objects only up to ``count_cap``
+    * ``disabled``: does not count objects, ``total_count`` is ``None``
+
+    The strategy which produced the number is returned as ``total_count_strategy``.
+
+    By setting ``bookmark_interval``, positions of objects at every multiple of
+    the interval are remembered (for ``bookmark_timeout`` seconds) in Django
+    cache per resource, filter and ordering, so that large integer offsets
+    are converted to a range query from the nearest bookmark and a small skip.
+
+    By setting ``use_facet``, pages with integer offsets and their exact count
+    are fetched with one aggregation using ``$facet`` (requires MongoDB 3.4+),
+    instead of two separate queries. It is not used together with bookmarks, nor
+    for querysets with their own skip, limit or hint.
     """
 
+    count_strategy = 'exact'
+    count_cap = 1000
+
+    bookmark_interval = None
+    bookmark_timeout = 3600
+
+    use_facet = False
+
+    COUNT_STRATEGIES = ('exact', 'estimated', 'capped', 'disabled')
+
     def get_limit(self):
         limit = getattr(settings, 'API_LIMIT_PER_PAGE', 20)
 
@@ -41,20 +159,79 @@ class Paginator(paginator.Paginator):
             try:
                 offset = int(offset)
             except ValueError:
-                raise exceptions.BadRequest("Invalid offset '%s' provided. Please provide an ObjectId or an integer." % offset)
+                try:
+                    offset = Cursor.from_token(offset)
+                except ValueError:
+                    raise exceptions.BadRequest("Invalid offset '%s' provided. Please provide an ObjectId, an integer or a cursor." % offset)
 
         if isinstance(offset, int) and offset < 0:
             raise exceptions.BadRequest("Invalid integer offset '%s' provided. Please provide a non-negative integer." % offset)
 
         return offset
 
+    def _is_queryset(self):
+        return hasattr(self.objects, '_document') and hasattr(self.objects, '_query')
+
+    def _is_unfiltered(self):
+        query = dict(self.objects._query)
+        cls_query = query.pop('_cls', None)
+
+        if query or getattr(self.objects, '_where_clause', None):
+            return False
+
+        # Only the base document class of a collection matches all its documents
+        return cls_query is None or '.' not in self.objects._document._class_name
+
+    def get_count(self):
+        if self.count_strategy not in self.COUNT_STRATEGIES:
+            raise django_exceptions.ImproperlyConfigured("Invalid count strategy '%s'." % self.count_strategy)
+
+        self.total_count_strategy = self.count_strategy
+
+        if self.count_strategy == 'disabled':
+            return None
+
+        if not self._is_queryset():
+            # It is cheap to count objects which are not in the database
+            self.total_count_strategy = 'exact'
+            return super(Paginator, self).get_count()
+
+        if self.count_strategy == 'estimated':
+            if self._is_unfiltered():
+                collection = self.objects._collection
+                # PyMongo 3.7+ deprecates count without a query
+                return getattr(collection, 'estimated_document_count', collection.count)()
+
+            self.total_count_strategy = 'exact'
+
+        elif self.count_strategy == 'capped':
+            count = self.objects.clone().limit(self.count_cap).count(with_limit_and_skip=True)
+            if count < self.count_cap:
+                # All objects were counted
+                self.total_count_strategy = 'exact'
+            return count
+
+        return super(Paginator, self).get_count()
+
     def get_slice(self, limit, offset):
         if isinstance(offset, int):
             if limit < 0:
                 raise exceptions.BadRequest("Invalid limit '%s' provided. Please provide a non-negative integer." % limit)
+            if self.bookmark_interval:
+                objects = self._get_bookmarked_slice(limit, offset)
+                if objects is not None:
+                    return objects
             return super(Paginator, self).get_slice(limit, offset)
 
-        # TODO: Very very inefficient, optimize!
+        if isinstance(offset, Cursor):
+            return self._get_cursor_slice(limit, offset)
+
+        objects = self._get_object_id_slice(limit, offset)
+        if objects is not None:
+            return objects
+
+        # Objects are not a MongoEngine queryset or they are ordered
+        # by arrays, so we have to find the offset by iterating
 
         if limit < 0:
             iterator = reversed(self.objects)
@@ -70,20 +247,350 @@ class Paginator(paginator.Paginator):
 
         return iterator
 
+    def _get_ordering(self):
+        """
+        Returns ordering of the queryset as a list of ``(db_field, direction)``
+        pairs, or ``None`` if objects are not a MongoEngine queryset.
+        """
+
+        if not hasattr(self.objects, '_ordering') or not hasattr(self.objects, '_document'):
+            return None
+
+        if self.objects._ordering:
+            return list(self.objects._ordering)
+
+        # MongoEngine applies document's default ordering only when cursor is created
+        default_ordering = self.objects._document._meta.get('ordering')
+        if default_ordering:
+            return list(self.objects.clone().order_by(*default_ordering)._ordering)
+
+        return []
+
+    def _get_keyset_ordering(self):
+        """
+        Returns ordering of the queryset with ObjectId added as a tiebreaker,
+        or ``None`` if objects are not a MongoEngine queryset.
+        """
+
+        ordering = self._get_ordering()
+        if ordering is None:
+            return None
+
+        if '_id' not in [key for key, direction in ordering]:
+            ordering.append(('_id', 1))
+
+        return ordering
+
+    def _order_by(self, objects, ordering):
+        # We set ordering directly as it is already in terms of database fields
+        objects = objects.clone()
+        objects._ordering = ordering
+        return objects
+
+    def _get_keyset_query(self, ordering, values, inclusive=False):
+        """
+        Returns a raw query matching objects which come strictly after
+        an object with given values of ordering fields (or also the
+        object itself, if ``inclusive`` is set).
+        """
+
+        clauses = []
+
+        for i, (key, direction) in enumerate(ordering):
+            clause = dict((k, v) for (k, d), v in zip(ordering[:i], values[:i]))
+            value = values[i]
+            last = i == len(ordering) - 1
+
+            # MongoDB compares only values of the same type, so we have
+            # to handle missing values (which sort first) specially
+            if direction > 0:
+                if value is None:
+                    if not (inclusive and last):
+                        clause[key] = {'$ne': None}
+                else:
+                    clause[key] = {'$gte' if inclusive and last else '$gt': value}
+            else:
+                if value is None:
+                    if not (inclusive and last):
+                        continue
+                    clause[key] = None
+                else:
+                    clause['$or'] = [{key: {'$lte' if inclusive and last else '$lt': value}}, {key: None}]
+
+            clauses.append(clause)
+
+        if not clauses:
+            return {'_id': {'$in': []}}
+        elif len(clauses) == 1:
+            return clauses[0]
+        else:
+            return {'$or': clauses}
+
+    def _get_bookmarks_key(self, ordering):
+        collection_name = self.objects._document._get_collection_name()
+        digest = hashlib.md5(json_util.dumps([self.resource_uri, self.objects._query, ordering], sort_keys=True)).hexdigest()
+        return BOOKMARKS_KEY % (collection_name, _get_bookmarks_generation(collection_name), digest)
+
+    def _get_bookmarked_slice(self, limit, offset):
+        """
+        Seeks to the nearest bookmark before the integer offset with a range
+        query and skips only the rest. If bookmark at the multiple of interval
+        before the offset is missing, it is stored for subsequent requests.
+
+        Returns ``None`` if this is not possible.
+        """
+
+        ordering = self._get_keyset_ordering()
+        if ordering is None:
+            return None
+
+        key = self._get_bookmarks_key(ordering)
+        bookmarks = cache.cache.get(key) or {}
+
+        target = offset - offset % self.bookmark_interval
+        base = max([position for position in bookmarks if position <= offset] or [0])
+
+        objects = self._order_by(self.objects, ordering)
+        if base:
+            objects = objects.filter(__raw__=self._get_keyset_query(ordering, bookmarks[base], inclusive=True))
+
+        if target > base:
+            obj = objects.skip(target - base).first()
+            if obj is None:
+                return []
+            cursor = self._get_cursor(obj, 1)
+            if cursor is None:
+                return None
+
+            bookmarks[target] = cursor.values
+            cache.cache.set(key, bookmarks, self.bookmark_timeout)
+
+            objects = self._order_by(self.objects.filter(__raw__=self._get_keyset_query(ordering, cursor.values, inclusive=True)), ordering)
+            base = target
+
+        objects = objects.skip(offset - base)
+
+        if limit:
+            objects = objects.limit(limit)
+
+        return objects
+
+    def _get_object_id_slice(self, limit, offset):
+        """
+        Seeks to the object with ObjectId offset with an (indexed) range query
+        over values of ordering fields and limits the number of returned objects
+        on the server. For negative limits ordering is inverted on the server.
+
+        Returns ``None`` if this is not possible.
+        """
+
+        ordering = self._get_keyset_ordering()
+        if ordering is None:
+            return None
+
+        if [key for key, direction in ordering] == ['_id']:
+            values = [offset]
+        else:
+            # We need values of ordering fields of the object at the offset
+            obj = self.objects.filter(pk=offset).first()
+            if obj is None:
+                return []
+            cursor = self._get_cursor(obj, 1)
+            if cursor is None:
+                return None
+            values = cursor.values
+
+        if limit < 0:
+            ordering = [(key, -direction) for key, direction in ordering]
+            limit = -limit
+
+        objects = self._order_by(self.objects.filter(__raw__=self._get_keyset_query(ordering, values, inclusive=True)), ordering)
+
+        if limit:
+            objects = objects.limit(limit)
+
+        return objects
+
+    def _get_cursor_slice(self, limit, cursor):
+        if limit < 0:
+            raise exceptions.BadRequest("Invalid limit '%s' provided. Please provide a non-negative integer." % limit)
+
+        ordering = self._get_keyset_ordering()
+        if ordering is None or ordering != cursor.ordering:
+            raise exceptions.BadRequest("Invalid offset '%s' provided. Cursor does not match ordering." % cursor)
+
+        if cursor.direction < 0:
+            # We fetch objects before the cursor by inverting the ordering
+            ordering = [(key, -direction) for key, direction in ordering]
+
+        objects = self._order_by(self.objects.filter(__raw__=self._get_keyset_query(ordering, cursor.values)), ordering)
+
+        if limit:
+            objects = objects.limit(limit)
+
+        if cursor.direction < 0:
+            # And flip them back into the requested order
+            objects = list(objects)
+            objects.reverse()
+
+        return objects
+
+    def _get_cursor(self, obj, direction):
+        ordering = self._get_keyset_ordering()
+        if ordering is None:
+            return None
+
+        data = obj.to_mongo()
+        values = []
+
+        for key, _ in ordering:
+            value = data
+            for name in key.split('.'):
+                value = value.get(name) if hasattr(value, 'get') else None
+            # MongoDB sorts arrays by their minimal or maximal element, which
+            # we cannot express with a range query, so we do not support them
+            if isinstance(value, (list, tuple)):
+                return None
+            values.append(value)
+
+        return Cursor(ordering, values, direction)
+
+    def _generate_cursor_uri(self, limit, obj, direction):
+        cursor = self._get_cursor(obj, direction)
+        if cursor is None:
+            return None
+        return self._generate_uri(limit, cursor.token)
+
+    def get_previous_cursor(self, limit, offset, objects):
+        if not objects or limit < 0:
+            return None
+
+        # Previous objects were fetched and we got less than requested, so there is nothing before them
+        if isinstance(offset, Cursor) and offset.direction < 0 and len(objects) < limit:
+            return None
+
+        return self._generate_cursor_uri(limit, objects[0], -1)
+
+    def get_next_cursor(self, limit, offset, objects):
+        if not objects or limit < 0:
+            return None
+
+        # Next objects were fetched and we got less than requested, so there is nothing after them
+        if not (isinstance(offset, Cursor) and offset.direction < 0) and len(objects) < limit:
+            return None
+
+        return self._generate_cursor_uri(limit, objects[-1], 1)
+
+    def _get_facet_page(self, limit, offset):
+        """
+        Fetches objects on the page and their total count with one aggregation.
+
+        Returns ``None`` if this is not possible.
+        """
+
+        if not self.use_facet or self.bookmark_interval or self.count_strategy != 'exact':
+            return None
+
+        if not isinstance(offset, int) or limit < 0 or not self._is_queryset():
+            return None
+
+        # $where cannot be used in aggregations
+        if getattr(self.objects, '_where_clause', None):
+            return None
+
+        # Nor can we apply queryset's own skip, limit or hint to both facets
+        if getattr(self.objects, '_skip', None) or getattr(self.objects, '_limit', None) is not None or getattr(self.objects, '_hint', -1) not in (-1, None):
+            return None
+
+        page_pipeline = [{'$skip': offset}]
+        if limit:
+            page_pipeline.append({'$limit': limit})
+
+        loaded_fields = getattr(self.objects, '_loaded_fields', None)
+        projection = loaded_fields.as_dict() if loaded_fields else None
+        if projection:
+            page_pipeline.append({'$project': projection})
+
+        pipeline = [{'$match': self.objects._query}]
+        ordering = self._get_ordering()
+        if ordering:
+            # We sort before $facet so that an index can be used
+            pipeline.append({'$sort': son.SON(ordering)})
+        pipeline.append({'$facet': {
+            'objects': page_pipeline,
+            'total_count': [{'$count': 'count'}],
+        }})
+
+        # Sorting without an index is limited in memory
+        result = self.objects._collection.aggregate(pipeline, allowDiskUse=True)
+        # PyMongo 2 returns a document instead of a cursor
+        if isinstance(result, dict):
+            result = result['result']
+        result = list(result)[0]
+
+        count = result['total_count'][0]['count'] if result['total_count'] else 0
+        objects = [self.objects._document._from_son(obj) for obj in result['objects']]
+
+        return count, objects
+
+    def page(self):
+        limit = self.get_limit()
+        offset = self.get_offset()
+
+        facet_page = self._get_facet_page(limit, offset)
+        if facet_page is not None:
+            count, objects = facet_page
+            self.total_count_strategy = 'exact'
+        else:
+            count = self.get_count()
+            objects = self.get_slice(limit, offset)
+
+        meta = {
+            'offset': offset.token if isinstance(offset, Cursor) else offset,
+            'limit': limit,
+            'total_count': count,
+            'total_count_strategy': self.total_count_strategy,
+        }
+
+        if limit:
+            if isinstance(offset, int) and self.total_count_strategy in ('capped', 'disabled'):
+                # We do not know the exact count, so there is a next page if this one is full
+                objects = list(objects)
+                meta['previous'] = self.get_previous(limit, offset)
+                meta['next'] = self._generate_uri(limit, offset + limit) if len(objects) >= limit else None
+            elif isinstance(offset, int):
+                meta['previous'] = self.get_previous(limit, offset)
+                meta['next'] = self.get_next(limit, offset, count)
+            else:
+                # Links for ObjectId and cursor offsets are generated from
+                # objects on the page, so we have to fetch them here
+                objects = list(objects)
+                meta['previous'] = self.get_previous_cursor(limit, offset, objects)
+                meta['next'] = self.get_next_cursor(limit, offset, objects)
+
+        # Resources can prepare all objects on the page at once, see MongoEngineResource.apply_sorting
+        prefetch = getattr(self.objects, '_prefetch_page', None)
+        if prefetch is not None:
+            objects = list(objects)
+            prefetch(objects)
+
+        return {
+            self.collection_name: objects,
+            'meta': meta,
+        }
+
     def get_previous(self, limit, offset):
         if isinstance(offset, int):
             return super(Paginator, self).get_previous(limit, offset)
 
-        # We do not support previous URI as the whole idea behind
-        # using ObjectId-based offsets is that integer offsets can
-        # become obsolete between requests
+        # Links for ObjectId and cursor offsets are generated
+        # from objects on the page, see get_previous_cursor
         return None
 
     def get_next(self, limit, offset, count):
         if isinstance(offset, int):
             return super(Paginator, self).get_next(limit, offset, count)
 
-        # We do not support next URI as the whole idea behind using
-        # ObjectId-based offsets is that integer offsets can become
-        # obsolete between requests
+        # Links for ObjectId and cursor offsets are generated
+        # from objects on the page, see get_next_cursor
         return None
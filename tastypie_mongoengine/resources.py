@@ -1,11 +1,19 @@
+import bisect
 import itertools
+import operator
 import re
 import sys
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
 
 from django.conf import urls
 from django.core import exceptions, urlresolvers
 from django.db.models import base as models_base
-from django.utils import datastructures
 
 try:
     # Django 1.5+
@@ -14,16 +22,21 @@ except ImportError:
     # Before Django 1.5
     from django.db.models.sql import constants
 
-from tastypie import bundle as tastypie_bundle, exceptions as tastypie_exceptions, fields as tastypie_fields, http, resources, utils
+from tastypie import authorization as tastypie_authorization, bundle as tastypie_bundle, exceptions as tastypie_exceptions, fields as tastypie_fields, http, resources, utils
+
+import bson
+from bson import son
+import pymongo
+from pymongo import errors as pymongo_errors
 
 import mongoengine
-from mongoengine import fields as mongoengine_fields, queryset
+from mongoengine import base as mongoengine_base, fields as mongoengine_fields, queryset, signals as mongoengine_signals
 try:
     from mongoengine.queryset import tranform as mongoengine_tranform
 except ImportError:
     mongoengine_tranform = None
 
-from tastypie_mongoengine import fields as tastypie_mongoengine_fields
+from tastypie_mongoengine import fields as tastypie_mongoengine_fields, paginator as tastypie_mongoengine_paginator
 
 from tastypie.exceptions import NotFound
 from django.core.urlresolvers import Resolver404
@@ -51,50 +64,391 @@ class NOT_HYDRATED(object):
     pass
 
 
-class ListQuerySet(datastructures.SortedDict):
+class DescendingKey(object):
+    """
+    Wraps a value in a composite sort key so that it is sorted in descending order.
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+class ListQuerySet(object):
+    """
+    A list of (embedded) objects with an interface of a queryset.
+
+    Objects are stored in a list together with a mapping between their keys
+    (stringified primary keys) and positions, so they can be accessed both
+    by position (like a list) and by key (like a dict) in constant time.
+
+    Indexes over field values are built lazily on first use and reused by
+    later filters on the same instance: hash indexes for exact lookups and
+    sorted indexes for range lookups. Indexes are reset when objects are
+    added or removed.
+    """
+
     # Workaround for https://github.com/toastdriven/django-tastypie/pull/670
     query = Query()
 
-    def _process_filter_value(self, value):
+    RANGE_LOOKUPS = ('gt', 'gte', 'lt', 'lte')
+    LIST_LOOKUPS = ('in', 'nin', 'all', 'mod')
+    STRING_LOOKUPS = ('iexact', 'contains', 'icontains', 'startswith', 'istartswith', 'endswith', 'iendswith')
+    LOOKUPS = ('exact', 'ne', 'size', 'exists') + RANGE_LOOKUPS + LIST_LOOKUPS + STRING_LOOKUPS
+
+    def __init__(self, items=None):
+        self._keys = []
+        self._objects = []
+        self._positions = {}
+        self._reset_indexes()
+
+        for key, obj in items or ():
+            self[key] = obj
+
+    def _reset_indexes(self):
+        self._hash_indexes = {}
+        self._sorted_indexes = {}
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def __setitem__(self, key, value):
+        # Like with a dict, setting an existing key keeps its position
+        assert isinstance(key, unicode), key
+        self._reset_indexes()
+        if key in self._positions:
+            self._objects[self._positions[key]] = value
+        else:
+            self._positions[key] = len(self._keys)
+            self._keys.append(key)
+            self._objects.append(value)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def pop(self, key, *args):
+        if key not in self._positions:
+            if args:
+                return args[0]
+            raise KeyError(key)
+
+        self._reset_indexes()
+        position = self._positions.pop(key)
+        del self._keys[position]
+        obj = self._objects.pop(position)
+        for moved_key in self._keys[position:]:
+            self._positions[moved_key] -= 1
+        return obj
+
+    def clear(self):
+        self._reset_indexes()
+        self._keys = []
+        self._objects = []
+        self._positions = {}
+
+    def get(self, key, default=None):
+        if key in self._positions:
+            return self._objects[self._positions[key]]
+        return default
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return list(self._objects)
+
+    def items(self):
+        return zip(self._keys, self._objects)
+
+    def iterkeys(self):
+        return iter(self._keys)
+
+    def itervalues(self):
+        return iter(self._objects)
+
+    def iteritems(self):
+        return itertools.izip(self._keys, self._objects)
+
+    def _process_filter_value(self, value, lookup='exact'):
         # Sometimes value is passed as a list of one value
         # (if filter was converted from QueryDict, for example)
-        if isinstance(value, (list, tuple)):
+        if lookup in self.LIST_LOOKUPS:
+            if isinstance(value, basestring):
+                return value.split(',')
+            return list(value)
+        elif isinstance(value, (list, tuple)):
             assert len(value) == 1
             return value[0]
         else:
             return value
 
+    def _parse_lookup(self, lookup):
+        """
+        Splits lookup into a field path, a lookup type and whether it is negated.
+        """
+
+        bits = lookup.split(constants.LOOKUP_SEP)
+        lookup_type = 'exact'
+        negated = False
+
+        if len(bits) > 1 and bits[-1] in QUERY_TERMS_ALL:
+            lookup_type = bits.pop()
+        if len(bits) > 1 and bits[-1] == 'not':
+            bits.pop()
+            negated = True
+
+        if lookup_type not in self.LOOKUPS:
+            raise tastypie_exceptions.InvalidFilterError("Unsupported filter: %s" % lookup)
+
+        return constants.LOOKUP_SEP.join(bits), lookup_type, negated
+
+    def _to_python(self, field, value):
+        # Filter values usually come from a query string, so we convert them
+        # to the type of the document field, if known (from the first object)
+        obj = next(iter(self.itervalues()), None)
+        document_field = getattr(obj, '_fields', {}).get(field)
+        if document_field is None or isinstance(document_field, (mongoengine_base.ComplexBaseField, mongoengine.EmbeddedDocumentField)):
+            return value
+        try:
+            if isinstance(document_field, mongoengine.DateTimeField):
+                return document_field.to_mongo(value)
+            return document_field.to_python(value)
+        except (TypeError, ValueError):
+            return value
+
+    def _convert_filter_value(self, field, lookup_type, value):
+        if lookup_type in self.STRING_LOOKUPS:
+            return unicode(value)
+        elif lookup_type in self.LIST_LOOKUPS:
+            return [self._to_python(field, v) for v in value]
+        elif lookup_type == 'mod':
+            return [int(v) for v in value]
+        elif lookup_type == 'size':
+            return int(value)
+        elif lookup_type == 'exists':
+            return value not in (False, None, 0, '0', 'false', 'False')
+        else:
+            return self._to_python(field, value)
+
+    def resolve_values(self, obj, field):
+        """
+        Returns all values at the field path of the object. Similarly to MongoDB,
+        lists along the path are traversed and their elements are all used.
+        """
+
+        values = [obj]
+        for name in field.split(constants.LOOKUP_SEP):
+            resolved = []
+            for value in values:
+                if isinstance(value, (list, tuple)):
+                    resolved.extend(getattr(v, name) for v in value if hasattr(v, name))
+                elif value is not None:
+                    resolved.append(getattr(value, name))
+            values = resolved
+        return values
+
+    def _expand_values(self, values):
+        # Similarly to MongoDB, lists match if any of their elements matches
+        expanded = []
+        for value in values:
+            if isinstance(value, (list, tuple)):
+                expanded.extend(value)
+            else:
+                expanded.append(value)
+        return expanded
+
+    def _compile_lookup(self, lookup_type, value):
+        """
+        Returns a function which tests a list of values at a field path.
+        """
+
+        def any_value(test):
+            return lambda values: any(test(v) for v in self._expand_values(values))
+
+        def any_string(test):
+            return any_value(lambda v: isinstance(v, basestring) and test(v))
+
+        if lookup_type == 'exact':
+            return any_value(lambda v: v == value)
+        elif lookup_type == 'iexact':
+            return any_string(lambda v: v.lower() == value.lower())
+        elif lookup_type == 'ne':
+            return lambda values: not any(v == value for v in self._expand_values(values))
+        elif lookup_type == 'gt':
+            return any_value(lambda v: v is not None and v > value)
+        elif lookup_type == 'gte':
+            return any_value(lambda v: v is not None and v >= value)
+        elif lookup_type == 'lt':
+            return any_value(lambda v: v is not None and v < value)
+        elif lookup_type == 'lte':
+            return any_value(lambda v: v is not None and v <= value)
+        elif lookup_type == 'in':
+            return any_value(lambda v: v in value)
+        elif lookup_type == 'nin':
+            return lambda values: not any(v in value for v in self._expand_values(values))
+        elif lookup_type == 'all':
+            return lambda values: all(v in self._expand_values(values) for v in value)
+        elif lookup_type == 'mod':
+            return any_value(lambda v: isinstance(v, (int, long, float)) and v % value[0] == value[1])
+        elif lookup_type == 'size':
+            return lambda values: any(isinstance(v, (list, tuple)) and len(v) == value for v in values)
+        elif lookup_type == 'exists':
+            return lambda values: any(v is not None for v in values) == value
+        elif lookup_type == 'contains':
+            return any_string(lambda v: value in v)
+        elif lookup_type == 'icontains':
+            return any_string(lambda v: value.lower() in v.lower())
+        elif lookup_type == 'startswith':
+            return any_string(lambda v: v.startswith(value))
+        elif lookup_type == 'istartswith':
+            return any_string(lambda v: v.lower().startswith(value.lower()))
+        elif lookup_type == 'endswith':
+            return any_string(lambda v: v.endswith(value))
+        elif lookup_type == 'iendswith':
+            return any_string(lambda v: v.lower().endswith(value.lower()))
+
+        assert False, lookup_type
+
+    def _get_hash_index(self, field):
+        """
+        Returns a mapping between values at the field path and keys of objects
+        with those values (in order), or ``None`` if values are not hashable.
+        """
+
+        if field not in self._hash_indexes:
+            index = {}
+            try:
+                for key, obj in self.iteritems():
+                    for value in set(self._expand_values(self.resolve_values(obj, field))):
+                        index.setdefault(value, []).append(key)
+            except TypeError:
+                index = None
+            self._hash_indexes[field] = index
+        return self._hash_indexes[field]
+
+    def _get_sorted_index(self, field):
+        """
+        Returns a pair of lists, sorted values at the field path (missing values are
+        skipped as they do not match range lookups) and corresponding keys.
+        """
+
+        if field not in self._sorted_indexes:
+            items = []
+            for key, obj in self.iteritems():
+                items.extend((value, key) for value in self._expand_values(self.resolve_values(obj, field)) if value is not None)
+            items.sort(key=operator.itemgetter(0))
+            self._sorted_indexes[field] = ([value for value, key in items], [key for value, key in items])
+        return self._sorted_indexes[field]
+
+    def _get_indexed_keys(self, field, lookup_type, value):
+        """
+        Returns keys (in order) of objects matching the lookup using an index,
+        or ``None`` if lookup cannot use an index.
+        """
+
+        if lookup_type == 'exact':
+            index = self._get_hash_index(field)
+            if index is None:
+                return None
+            try:
+                return index.get(value, [])
+            except TypeError:
+                return None
+
+        if lookup_type not in self.RANGE_LOOKUPS:
+            return None
+
+        values, keys = self._get_sorted_index(field)
+        if lookup_type == 'gt':
+            keys = keys[bisect.bisect_right(values, value):]
+        elif lookup_type == 'gte':
+            keys = keys[bisect.bisect_left(values, value):]
+        elif lookup_type == 'lt':
+            keys = keys[:bisect.bisect_left(values, value)]
+        else:
+            keys = keys[:bisect.bisect_right(values, value)]
+
+        return sorted(set(keys), key=self._positions.__getitem__)
+
     def filter(self, **kwargs):
-        result = self
+        """
+        Filters objects with lookups supported by MongoEngine (except geospatial
+        ones and ``match``). Lookups which can use an index narrow down candidate
+        objects first, the rest are compiled into one predicate which is then
+        applied in a single pass over candidates.
+        """
+
+        keys = None
+        tests = []
 
         # pk optimization
         if 'pk' in kwargs:
             pk = unicode(self._process_filter_value(kwargs.pop('pk')))
-            if pk in result:
-                result = ListQuerySet([(unicode(pk), result[pk])])
+            if pk in self:
+                keys = [pk]
             # Sometimes None is passed as a pk to not filter by pk
             elif pk is not None:
-                result = ListQuerySet()
+                keys = []
+
+        try:
+            for lookup, value in kwargs.iteritems():
+                field, lookup_type, negated = self._parse_lookup(lookup)
+                value = self._convert_filter_value(field, lookup_type, self._process_filter_value(value, lookup_type))
+
+                matching = None
+                if not negated:
+                    matching = self._get_indexed_keys(field, lookup_type, value)
+
+                if matching is None:
+                    test = self._compile_lookup(lookup_type, value)
+                    if negated:
+                        test = (lambda test: lambda values: not test(values))(test)
+                    tests.append((field, test))
+                elif keys is None:
+                    keys = matching
+                else:
+                    matching = set(matching)
+                    keys = [key for key in keys if key in matching]
 
-        for field, value in kwargs.iteritems():
-            value = self._process_filter_value(value)
-            if constants.LOOKUP_SEP in field:
-                raise tastypie_exceptions.InvalidFilterError("Unsupported filter: (%s, %s)" % (field, value))
+            if keys is None:
+                if not tests:
+                    return self
+                keys = self._keys
 
-            try:
-                result = ListQuerySet([(unicode(obj.pk), obj) for obj in result.itervalues() if getattr(obj, field) == value])
-            except AttributeError as ex:
-                raise tastypie_exceptions.InvalidFilterError(ex)
+            if tests:
+                keys = [key for key in keys if all(test(self.resolve_values(self[key], field)) for field, test in tests)]
 
-        return result
+        except (AttributeError, TypeError, ValueError) as ex:
+            # Values which cannot be compared (like datetime with None) raise TypeError
+            raise tastypie_exceptions.InvalidFilterError(ex)
+
+        return ListQuerySet([(key, self[key]) for key in keys])
 
     def attrgetter(self, attr):
+        names = attr.split(constants.LOOKUP_SEP)
+
         def getter(obj):
-            return self.resolve_attr(obj, attr)
+            return self._resolve_names(obj, names)
         return getter
 
     def resolve_attr(self, obj, attr):
-        for name in attr.split(constants.LOOKUP_SEP):
+        return self._resolve_names(obj, attr.split(constants.LOOKUP_SEP))
+
+    def _resolve_names(self, obj, names):
+        for name in names:
             while isinstance(obj, list):
                 # Try to be a bit similar to MongoDB
                 for o in obj:
@@ -107,45 +461,407 @@ class ListQuerySet(datastructures.SortedDict):
         return obj
 
     def order_by(self, *field_names):
+        """
+        Orders objects by all fields with one sort over composite keys,
+        which are computed once per object.
+        """
+
         if not len(field_names):
             return self
 
-        result = self
-
-        for field in reversed(field_names):
+        getters = []
+        for field in field_names:
             if field.startswith('-'):
-                reverse = True
-                field = field[1:]
+                getters.append((self.attrgetter(field[1:]), True))
             else:
-                reverse = False
+                getters.append((self.attrgetter(field), False))
 
-            try:
-                result = [(unicode(obj.pk), obj) for obj in sorted(result, key=self.attrgetter(field), reverse=reverse)]
-            except (AttributeError, IndexError) as ex:
-                raise tastypie_exceptions.InvalidSortError(ex)
+        def composite_key(item):
+            key, obj = item
+            return tuple(DescendingKey(getter(obj)) if descending else getter(obj) for getter, descending in getters)
 
-        return ListQuerySet(result)
+        try:
+            keys = [(composite_key(item), item) for item in self.iteritems()]
+        except (AttributeError, IndexError) as ex:
+            raise tastypie_exceptions.InvalidSortError(ex)
+
+        # Sort is stable, so objects with equal keys keep their order
+        keys.sort(key=operator.itemgetter(0))
+
+        return ListQuerySet([item for key, item in keys])
 
     def __iter__(self):
         return self.itervalues()
 
     def __reversed__(self):
-        for key in reversed(self.keyOrder):
-            yield self[key]
+        return reversed(self._objects)
 
     def __getitem__(self, key):
-        # Tastypie access object_list[0], so we pretend to be
-        # a list here (order is same as our iteration order)
+        # Tastypie access object_list[0] and sliced object_list
+        # in paginator, so we pretend to be a list here
+        if isinstance(key, (int, long, slice)):
+            return self._objects[key]
+        else:
+            # We could convert silently to unicode here, but it is
+            # better to check to find possible errors in program logic
+            assert isinstance(key, unicode), key
+            return self._objects[self._positions[key]]
+
+
+class EmbeddedListQuerySet(ListQuerySet):
+    """
+    ListQuerySet over a list of embedded documents which is materialized lazily.
+
+    Documents are prepared (their primary key is linked to the ``id_field``
+    or set to their index) only when they are accessed, so accessing one
+    document by position or key, or a slice of documents, does not require
+    going over the whole list. Everything else materializes the whole list
+    first. Documents with ``id_field`` can be looked up with ``find_position``,
+    which returns the index of the document with the given key or ``None``.
+    """
+
+    def __init__(self, documents, pk_field=None, find_position=None):
+        self._documents = documents
+        self._pk_field = pk_field
+        self._find_position = find_position
+        self._linked_classes = set()
+        self._reset_indexes()
+
+    def __getattr__(self, name):
+        # Internal lists and mappings are created only when needed
+        if name in ('_keys', '_objects', '_positions'):
+            self._materialize()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def _materialize(self):
+        self._objects = [self._prepare(index, obj) for index, obj in enumerate(self._documents)]
+        self._keys = [self._get_key(index, obj) for index, obj in enumerate(self._objects)]
+        self._positions = dict((key, position) for position, key in enumerate(self._keys))
+
+    def _is_materialized(self):
+        return '_objects' in self.__dict__
+
+    def _prepare(self, index, obj):
+        if self._pk_field is None:
+            obj.pk = index
+        elif obj.__class__ not in self._linked_classes:
+            obj.__class__.pk = tastypie_mongoengine_fields.link_property(self._pk_field)
+            self._linked_classes.add(obj.__class__)
+        return obj
+
+    def _get_key(self, index, obj):
+        if self._pk_field is None:
+            return unicode(index)
+        return unicode(getattr(obj, self._pk_field))
+
+    def _find(self, key):
+        """
+        Returns the index of the document with the key, or ``None``.
+        """
+
+        if self._is_materialized():
+            return self._positions.get(key)
+
+        if self._pk_field is None:
+            try:
+                index = int(key)
+            except ValueError:
+                return None
+            if unicode(index) == key and 0 <= index < len(self._documents):
+                return index
+            return None
+
+        if self._find_position is not None:
+            return self._find_position(key)
+
+        for index, obj in enumerate(self._documents):
+            if unicode(getattr(obj, self._pk_field)) == key:
+                return index
+        return None
+
+    def __len__(self):
+        if self._is_materialized():
+            return len(self._objects)
+        return len(self._documents)
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def get(self, key, default=None):
+        index = self._find(key)
+        if index is None:
+            return default
+        return self[index]
+
+    def __getitem__(self, key):
+        if self._is_materialized():
+            return super(EmbeddedListQuerySet, self).__getitem__(key)
+
         if isinstance(key, (int, long)):
-            return itertools.islice(self, key, key + 1).next()
-        # Tastypie also access sliced object_list in paginator
+            index = xrange(len(self._documents))[key]
+            return self._prepare(index, self._documents[index])
         elif isinstance(key, slice):
-            return itertools.islice(self, key.start, key.stop, key.step)
+            indices = range(*key.indices(len(self._documents)))
+            return [self._prepare(index, self._documents[index]) for index in indices]
         else:
             # We could convert silently to unicode here, but it is
             # better to check to find possible errors in program logic
             assert isinstance(key, unicode), key
-            return super(ListQuerySet, self).__getitem__(key)
+            index = self._find(key)
+            if index is None:
+                raise KeyError(key)
+            return self[index]
+
+
+class AggregatedListQuerySet(EmbeddedListQuerySet):
+    """
+    ListQuerySet over a list of embedded documents in a document stored in
+    the database, which filters, orders and slices the list with an
+    aggregation, so that only requested embedded documents are fetched.
+
+    Requires MongoDB 3.2 or newer.
+    """
+
+    INDEX_FIELD = '_index'
+
+    # Attributes are not named like those of QuerySet, so that
+    # paginator does not mistake this for a MongoEngine QuerySet
+
+    def __init__(self, document, field_name, pk_field=None, matches=(), ordering=()):
+        self._parent_document = document
+        self._field_name = field_name
+        self._pk_field = pk_field
+        self._matches = list(matches)
+        self._sort = list(ordering)
+        self._linked_classes = set()
+        self._reset_indexes()
+
+        field = document._fields[field_name]
+        self._db_field = field.db_field
+        self._embedded_class = field.field.document_type
+
+    def _clone(self, matches=(), ordering=None):
+        return self.__class__(
+            self._parent_document,
+            self._field_name,
+            self._pk_field,
+            self._matches + list(matches),
+            self._sort if ordering is None else ordering,
+        )
+
+    def _get_pipeline(self):
+        id_field = self._parent_document._fields[self._parent_document._meta['id_field']]
+
+        pipeline = [
+            {'$match': {'_id': id_field.to_mongo(self._parent_document.pk)}},
+            {'$project': {self._db_field: 1}},
+            {'$unwind': {'path': '$%s' % self._db_field, 'includeArrayIndex': self.INDEX_FIELD}},
+        ]
+        pipeline.extend({'$match': match} for match in self._matches)
+        if self._sort:
+            # Index makes the order the same as when ordering a list
+            pipeline.append({'$sort': son.SON(self._sort + [(self.INDEX_FIELD, 1)])})
+        return pipeline
+
+    def _aggregate(self, pipeline):
+        result = self._parent_document._get_collection().aggregate(pipeline)
+        # PyMongo 2 returns a document instead of a cursor
+        if isinstance(result, dict):
+            result = result['result']
+        return list(result)
+
+    def _fetch(self, skip=0, limit=None):
+        if limit == 0:
+            return []
+
+        pipeline = self._get_pipeline()
+        if skip:
+            pipeline.append({'$skip': skip})
+        if limit is not None:
+            pipeline.append({'$limit': limit})
+
+        return [self._prepare(data[self.INDEX_FIELD], self._embedded_class._from_son(data[self._db_field])) for data in self._aggregate(pipeline)]
+
+    def _materialize(self):
+        self._objects = self._fetch()
+        self._keys = [self._get_key(obj.pk, obj) for obj in self._objects]
+        self._positions = dict((key, position) for position, key in enumerate(self._keys))
+
+    def _find(self, key):
+        return self._positions.get(key)
+
+    def _get_match(self, **kwargs):
+        query = queryset.Q(**kwargs).to_query(self._embedded_class)
+        return dict(('%s.%s' % (self._db_field, key), value) for key, value in query.iteritems())
+
+    def _get_pk_match(self, pk):
+        pk = unicode(self._process_filter_value(pk))
+
+        if self._pk_field is not None:
+            return self._get_match(**{self._pk_field: pk})
+
+        try:
+            index = int(pk)
+        except ValueError:
+            index = None
+        if index is None or unicode(index) != pk:
+            # Matches nothing, as indices are never negative
+            index = -1
+        return {self.INDEX_FIELD: index}
+
+    def filter(self, **kwargs):
+        """
+        Converts lookups to a ``$match`` stage over embedded documents.
+        """
+
+        matches = []
+
+        # Sometimes None is passed as a pk to not filter by pk
+        pk = kwargs.pop('pk', None)
+        if pk is not None:
+            matches.append(self._get_pk_match(pk))
+
+        try:
+            for lookup, value in kwargs.iteritems():
+                field, lookup_type, negated = self._parse_lookup(lookup)
+                value = self._process_filter_value(value, lookup_type)
+                if lookup_type in ('mod', 'size', 'exists'):
+                    value = self._convert_filter_value(field, lookup_type, value)
+                matches.append(self._get_match(**{lookup: value}))
+        except (mongoengine.InvalidQueryError, mongoengine.LookUpError, mongoengine.ValidationError, ValueError, TypeError) as ex:
+            raise tastypie_exceptions.InvalidFilterError(ex)
+
+        if not matches:
+            return self
+
+        return self._clone(matches=matches)
+
+    def order_by(self, *field_names):
+        """
+        Converts field names to a ``$sort`` stage over embedded documents.
+        """
+
+        if not len(field_names):
+            return self
+
+        ordering = []
+        try:
+            for field in field_names:
+                direction = 1
+                if field.startswith('-'):
+                    field = field[1:]
+                    direction = -1
+                ordering.append(('%s.%s' % (self._db_field, self._embedded_class._translate_field_name(field, constants.LOOKUP_SEP)), direction))
+        except mongoengine.LookUpError as ex:
+            raise tastypie_exceptions.InvalidSortError(ex)
+
+        return self._clone(ordering=ordering)
+
+    def __len__(self):
+        if self._is_materialized():
+            return len(self._objects)
+
+        result = self._aggregate(self._get_pipeline() + [{'$group': {'_id': None, 'count': {'$sum': 1}}}])
+        return result[0]['count'] if result else 0
+
+    def __getitem__(self, key):
+        if self._is_materialized():
+            return super(AggregatedListQuerySet, self).__getitem__(key)
+
+        if isinstance(key, (int, long)):
+            if key < 0:
+                key += len(self)
+            objects = self._fetch(key, 1) if key >= 0 else []
+            if not objects:
+                raise IndexError("list index out of range")
+            return objects[0]
+        elif isinstance(key, slice):
+            if key.step is not None or (key.start or 0) < 0 or (key.stop is not None and key.stop < 0):
+                return self._objects[key]
+            start = key.start or 0
+            if key.stop is None:
+                return self._fetch(start)
+            return self._fetch(start, max(key.stop - start, 0))
+        else:
+            return super(AggregatedListQuerySet, self).__getitem__(key)
+
+
+def overrides_document_method(document_class, name):
+    method = getattr(mongoengine.Document, name, None)
+    if method is None:
+        return False
+    return getattr(getattr(document_class, name), 'im_func', None) is not method.im_func
+
+
+def has_custom_save(document_class):
+    """
+    Returns ``True`` if saving documents of the given class does more than
+    writing them, because the class overrides ``save`` or there are receivers
+    of save signals.
+    """
+
+    if overrides_document_method(document_class, 'save'):
+        return True
+
+    if not mongoengine_signals.signals_available:
+        return False
+
+    for name in ('pre_save', 'pre_save_post_validation', 'post_save'):
+        signal = getattr(mongoengine_signals, name, None)
+        if signal is not None and signal.has_receivers_for(document_class):
+            return True
+
+    return False
+
+
+def write_error(code, message):
+    # Errors of raw writes are raised like MongoEngine raises them when saving
+    if code in (11000, 11001):
+        return mongoengine.NotUniqueError(message)
+    return mongoengine.ValidationError(message)
+
+
+# How many resolved resource URIs are remembered by resolve_uri
+RESOLVE_URI_CACHE_SIZE = 1000
+
+_resolved_uris = OrderedDict()
+_resolved_uris_lock = threading.Lock()
+
+
+def resolve_uri(uri):
+    """
+    Resolves resource URI and returns keyword arguments of its view. The most
+    recently used URIs are cached per URLconf and script prefix.
+    """
+
+    # URLconf can be set per request
+    urlconf = urlresolvers.get_urlconf()
+    prefix = urlresolvers.get_script_prefix()
+    key = (urlconf, prefix, uri)
+
+    with _resolved_uris_lock:
+        kwargs = _resolved_uris.pop(key, None)
+        if kwargs is not None:
+            _resolved_uris[key] = kwargs
+            return dict(kwargs)
+
+    chomped_uri = uri
+
+    if prefix and chomped_uri.startswith(prefix):
+        chomped_uri = chomped_uri[len(prefix) - 1:]
+
+    try:
+        view, args, kwargs = urlresolvers.resolve(chomped_uri, urlconf)
+    except Resolver404:
+        raise NotFound("The URL provided '%s' was not a link to a valid resource." % uri)
+
+    with _resolved_uris_lock:
+        _resolved_uris[key] = kwargs
+        while len(_resolved_uris) > RESOLVE_URI_CACHE_SIZE:
+            del _resolved_uris[next(iter(_resolved_uris))]
+
+    return dict(kwargs)
 
 
 # Adapted from PEP 257
@@ -252,6 +968,19 @@ class MongoEngineModelDeclarativeMetaclass(resources.ModelDeclarativeMetaclass):
             else:
                 seen_types.add(type_map[typ]._meta.object_class)
 
+        # Resources by names in URIs, so that get_via_uri can directly use the right one
+        new_class._resources_by_name = dict((resource._meta.resource_name, resource) for resource in type_map.itervalues())
+        new_class._resources_by_name[new_class._meta.resource_name] = new_class
+
+        # Types and resources by document classes, for _get_type_from_class and _get_resource_from_class
+        new_class._types_by_class = {}
+        new_class._last_types_by_class = {}
+        new_class._resources_by_class = {}
+        for typ, resource in type_map.iteritems():
+            new_class._types_by_class.setdefault(resource._meta.object_class, typ)
+            new_class._last_types_by_class[resource._meta.object_class] = typ
+            new_class._resources_by_class.setdefault(resource._meta.object_class, resource)
+
         if new_class._meta.object_class:
             # In MongoEngine 0.7.6+ embedded documents do not have exceptions anymore,
             # but this prevents are from reusing existing Tastypie code
@@ -284,21 +1013,89 @@ class MongoEngineResource(resources.ModelResource):
 
         If you need custom behavior based on other portions of the URI,
         simply override this method.
+
+        For polymorphic resources, the resource to use is chosen by resource
+        name in the URI, so that the object is loaded with one query.
         """
-        try:
-            return super(MongoEngineResource, self).get_via_uri(uri, request)
-        except (NotFound, Resolver404):
-            # if this is a polymorphic resource check the uri against the resources in self._meta.polymorphic
-            type_map = getattr(self._meta, 'polymorphic', {})
-            for type_, resource in type_map.iteritems():
+
+        kwargs = resolve_uri(uri)
+        resource = self._get_resource_by_name(kwargs.get('resource_name')) or self
+
+        bundle = resource.build_bundle(request=request)
+        return resource.obj_get(bundle=bundle, **resource.remove_api_resource_names(kwargs))
+
+    def _get_resource_by_name(self, resource_name, resources=None):
+        if resource_name == self._meta.resource_name:
+            return self
+
+        resource_class = self._resources_by_name.get(resource_name)
+        if resource_class is None:
+            return None
+
+        if resources is None:
+            return resource_class(api_name=self._meta.api_name)
+        if resource_class not in resources:
+            resources[resource_class] = resource_class(api_name=self._meta.api_name)
+        return resources[resource_class]
+
+    def get_via_uris(self, uris, request=None, trust=False):
+        """
+        A version of ``get_via_uri`` for many URIs at once. Objects of detail
+        URIs of this resource or its polymorphic resources are loaded with one
+        query per resource, other URIs are processed with ``get_via_uri``.
+
+        If ``trust`` is set, objects are not loaded, but only documents with the
+        primary key from the URI are returned instead.
+
+        Returns a dictionary mapping URIs to objects. URIs of objects which do not
+        exist are not included.
+        """
+
+        resources = {}
+        lookups = {}
+        objs = {}
+
+        for uri in uris:
+            kwargs = resolve_uri(uri)
+
+            resource = self._get_resource_by_name(kwargs.get('resource_name'), resources)
+            if resource is not None:
+                kwargs = resource.remove_api_resource_names(kwargs)
+
+            if resource is None or kwargs.keys() != ['pk']:
                 try:
-                    return resource().get_via_uri(uri, request)
-                except (NotFound, Resolver404):
+                    objs[uri] = self.get_via_uri(uri, request)
+                except exceptions.ObjectDoesNotExist:
                     pass
-            # the uri wasn't found at any of the polymorphic resources, it is an incorrect URI for this resource
-            raise
-        except Exception, e:
-            raise e
+                continue
+
+            document_class = resource._meta.object_class
+            id_field = document_class._fields[document_class._meta['id_field']]
+            try:
+                pk = id_field.to_mongo(kwargs['pk'])
+            except mongoengine.ValidationError:
+                continue
+
+            lookups.setdefault(resource, {}).setdefault(pk, []).append(uri)
+
+        for resource, resource_lookups in lookups.iteritems():
+            document_class = resource._meta.object_class
+            id_field = document_class._fields[document_class._meta['id_field']]
+
+            if trust:
+                resource_objs = [tastypie_mongoengine_fields.document_stub(document_class, pk) for pk in resource_lookups]
+            else:
+                object_list = resource.get_object_list(request).filter(pk__in=resource_lookups.keys())
+                resource_objs = list(object_list)
+                # Like obj_get, each object is authorized on its own
+                for obj in resource_objs:
+                    resource.authorized_read_detail(object_list, resource.build_bundle(obj=obj, request=request))
+
+            for obj in resource_objs:
+                for uri in resource_lookups.get(id_field.to_mongo(obj.pk), ()):
+                    objs[uri] = obj
+
+        return objs
 
     # Data preparation.
 
@@ -432,7 +1229,17 @@ class MongoEngineResource(resources.ModelResource):
     def get_schema(self, request, **kwargs):
         return self._wrap_request(request, lambda: super(MongoEngineResource, self).get_schema(request, **kwargs))
 
+    def _get_mapped_class(self, cls):
+        # The nearest document class in MRO of the given class which is used by polymorphic resources
+        for base in cls.__mro__:
+            if base in self._types_by_class:
+                return base
+        raise KeyError(cls)
+
     def _get_resource_from_class(self, type_map, cls):
+        if type_map is getattr(self._meta, 'polymorphic', None):
+            return self._resources_by_class[self._get_mapped_class(cls)]
+
         for resource in type_map.itervalues():
             if resource._meta.object_class is cls:
                 return resource
@@ -441,7 +1248,13 @@ class MongoEngineResource(resources.ModelResource):
     def _get_type_from_class(self, type_map, cls):
         # As we are overriding self._meta.object_class we have to make sure
         # that we do not miss real match, so if self._meta.object_class
-        # matches, we still check other items, otherwise we return immediately
+        # matches, we use the last matching type, otherwise the first one
+        if type_map is getattr(self._meta, 'polymorphic', None):
+            cls = self._get_mapped_class(cls)
+            if cls is self._meta.object_class:
+                return self._last_types_by_class[cls]
+            return self._types_by_class[cls]
+
         res = None
         for typ, resource in type_map.iteritems():
             if resource._meta.object_class is cls:
@@ -562,10 +1375,31 @@ class MongoEngineResource(resources.ModelResource):
 
         return data
 
-    def obj_get(self, bundle, **kwargs):
+    def obj_get(self, bundle, exclude_fields=None, **kwargs):
+        """
+        A version of Tastypie's ``obj_get`` which can exclude fields given in
+        ``exclude_fields`` from loading. Such incomplete document should not
+        be saved or cached.
+        """
+
         # MongoEngine exceptions are separate from Django exceptions, we combine them here
         try:
-            return super(MongoEngineResource, self).obj_get(bundle=bundle, **kwargs)
+            object_list = self.get_object_list(bundle.request)
+            if exclude_fields:
+                object_list = object_list.exclude(*exclude_fields)
+            object_list = object_list.filter(**kwargs)
+            stringified_kwargs = ', '.join(["%s=%s" % (k, v) for k, v in kwargs.items()])
+
+            if len(object_list) <= 0:
+                raise self._meta.object_class.DoesNotExist("Couldn't find an instance of '%s' which matched '%s'." % (self._meta.object_class.__name__, stringified_kwargs))
+            elif len(object_list) > 1:
+                raise exceptions.MultipleObjectsReturned("More than '%s' matched '%s'." % (self._meta.object_class.__name__, stringified_kwargs))
+
+            bundle.obj = object_list[0]
+            self.authorized_read_detail(object_list, bundle)
+            return bundle.obj
+        except ValueError:
+            raise tastypie_exceptions.NotFound("Invalid resource lookup data provided (mismatched type).")
         except self._meta.object_class.DoesNotExist as ex:
             exp = models_base.subclass_exception('DoesNotExist', (self._meta.object_class.DoesNotExist, exceptions.ObjectDoesNotExist), self._meta.object_class.DoesNotExist.__module__)
             raise exp(*ex.args)
@@ -582,9 +1416,95 @@ class MongoEngineResource(resources.ModelResource):
             exp = models_base.subclass_exception('DoesNotExist', (queryset.DoesNotExist, exceptions.ObjectDoesNotExist), queryset.DoesNotExist.__module__)
             raise exp(*ex.args)
 
+    def apply_sorting(self, obj_list, options=None):
+        obj_list = super(MongoEngineResource, self).apply_sorting(obj_list, options)
+        # Paginator calls it with documents on the page, before they are dehydrated
+        obj_list._prefetch_page = self.prefetch_references
+        return obj_list
+
+    def _get_referenced_document_type(self, obj, attribute):
+        field = getattr(obj, '_fields', {}).get(attribute)
+        if isinstance(field, mongoengine.ListField):
+            field = field.field
+        if isinstance(field, mongoengine.ReferenceField):
+            return field.document_type
+        return None
+
+    def prefetch_references(self, objs, depth=None):
+        """
+        Loads documents referenced by full ``ReferenceField`` and ``ReferencedListField``
+        fields of all given documents with one query per referenced document class,
+        and attaches them to the documents. Referenced documents are then processed
+        by their resources in the same way, up to ``prefetch_depth`` levels.
+        """
+
+        if depth is None:
+            depth = getattr(self._meta, 'prefetch_depth', 1)
+
+        if depth <= 0 or not objs:
+            return
+
+        fields = [
+            field_object for field_object in self.fields.itervalues()
+            if isinstance(field_object, (tastypie_mongoengine_fields.ReferenceField, tastypie_mongoengine_fields.ReferencedListField)) and field_object.full and isinstance(field_object.attribute, basestring)
+        ]
+
+        # References are stored as DBRefs in documents' data until they are accessed
+        references = []
+        for field_object in fields:
+            for obj in objs:
+                document_type = self._get_referenced_document_type(obj, field_object.attribute)
+                if document_type is not None:
+                    references.append((field_object, obj, document_type))
+
+        ids = {}
+        for field_object, obj, document_type in references:
+            values = obj._data.get(field_object.attribute)
+            for value in values if isinstance(values, (list, tuple)) else [values]:
+                if isinstance(value, bson.DBRef) and value.collection == document_type._get_collection_name():
+                    ids.setdefault(document_type, set()).add(value.id)
+
+        documents = {}
+        for document_type, document_ids in ids.iteritems():
+            for pk, document in document_type.objects.in_bulk(list(document_ids)).iteritems():
+                documents[(document_type, pk)] = document
+
+        related = {}
+        for field_object, obj, document_type in references:
+            def resolve(value):
+                if isinstance(value, bson.DBRef):
+                    return documents.get((document_type, value.id), value)
+                return value
+
+            values = obj._data.get(field_object.attribute)
+            if values is None:
+                continue
+            elif isinstance(values, (list, tuple)):
+                values = [resolve(value) for value in values]
+            else:
+                values = resolve(values)
+            obj._data[field_object.attribute] = values
+
+            related.setdefault(field_object, []).extend(value for value in (values if isinstance(values, list) else [values]) if isinstance(value, mongoengine.Document))
+
+        for field_object, related_objs in related.iteritems():
+            resource = field_object.to_class(self._meta.api_name)
+            if related_objs and hasattr(resource, 'prefetch_references'):
+                resource.prefetch_references(related_objs, depth - 1)
+
+    def _invalidate_bookmarks(self):
+        """
+        Invalidates offset bookmarks if paginator is using them.
+        """
+
+        if getattr(self._meta.paginator_class, 'bookmark_interval', None):
+            tastypie_mongoengine_paginator.invalidate_bookmarks(self._meta.object_class)
+
     def obj_create(self, bundle, **kwargs):
         self._reset_collection()
-        return super(MongoEngineResource, self).obj_create(bundle, **kwargs)
+        bundle = super(MongoEngineResource, self).obj_create(bundle, **kwargs)
+        self._invalidate_bookmarks()
+        return bundle
 
     # TODO: Use skip_errors?
     def obj_update(self, bundle, skip_errors=False, **kwargs):
@@ -597,8 +1517,34 @@ class MongoEngineResource(resources.ModelResource):
                 raise tastypie_exceptions.NotFound("A document instance matching the provided arguments could not be found.")
 
         self.authorized_update_detail(self.get_object_list(bundle.request), bundle)
+
+        # We compare stored values before and after hydration to write only real changes
+        original = bundle.obj.to_mongo()
         bundle = self.full_hydrate(bundle)
-        return self.save(bundle, skip_errors=skip_errors)
+        changed = self._mark_changed_fields(bundle.obj, original)
+
+        bundle = self.save(bundle, skip_errors=skip_errors)
+        if changed:
+            self._invalidate_bookmarks()
+        return bundle
+
+    def _mark_changed_fields(self, obj, original):
+        """
+        Marks as changed only those fields of the document whose stored values
+        differ from the original ones, so that saving it writes only them, or
+        nothing if there are no such fields. Returns their database names.
+        """
+
+        current = obj.to_mongo()
+        changed = [key for key, value in current.iteritems() if key not in original or original[key] != value]
+        changed.extend(key for key in original if key not in current)
+        changed = [key for key in changed if key != '_id']
+
+        # Hydration can mark as changed also fields (and embedded documents) which did not change
+        obj._clear_changed_fields()
+        obj._changed_fields = changed
+
+        return changed
 
     def obj_delete(self, bundle, **kwargs):
         self._reset_collection()
@@ -606,10 +1552,22 @@ class MongoEngineResource(resources.ModelResource):
         # MongoEngine exceptions are separate from Django exceptions and Tastypie
         # expects Django exceptions, so we catch it here ourselves and raise NotFound
         try:
-            return super(MongoEngineResource, self).obj_delete(bundle, **kwargs)
+            super(MongoEngineResource, self).obj_delete(bundle, **kwargs)
         except queryset.DoesNotExist:
             raise tastypie_exceptions.NotFound("A document instance matching the provided arguments could not be found.")
 
+        self._invalidate_bookmarks()
+
+    def obj_delete_list(self, bundle, **kwargs):
+        self._reset_collection()
+        super(MongoEngineResource, self).obj_delete_list(bundle, **kwargs)
+        self._invalidate_bookmarks()
+
+    def obj_delete_list_for_update(self, bundle, **kwargs):
+        self._reset_collection()
+        super(MongoEngineResource, self).obj_delete_list_for_update(bundle, **kwargs)
+        self._invalidate_bookmarks()
+
     def create_identifier(self, obj):
         return unicode(obj.pk)
 
@@ -623,6 +1581,8 @@ class MongoEngineResource(resources.ModelResource):
         # Our related documents are not stored in a queryset, but a list,
         # so we have to manually build a list, set it, and save
 
+        related_objs = {}
+
         for field_name, field_object in self.fields.items():
             if not getattr(field_object, 'is_m2m', False):
                 continue
@@ -633,14 +1593,129 @@ class MongoEngineResource(resources.ModelResource):
             if field_object.readonly:
                 continue
 
-            related_objs = []
+            related_objs[field_object.attribute] = [related_bundle.obj for related_bundle in bundle.data[field_name]]
+
+        if not related_objs:
+            return
+
+        objs = itertools.chain(*related_objs.values())
+        if getattr(self._meta, 'bulk_save_related', False):
+            # Related documents of all fields are saved together
+            self._save_documents(objs)
+        else:
+            seen = set()
+            for obj in objs:
+                # Documents with only the primary key (see trust_uris) have nothing to save
+                if id(obj) in seen or getattr(obj, '_is_stub', False):
+                    continue
+                seen.add(id(obj))
+                obj.save()
+
+        # The document is saved once
+        for attribute, objs in related_objs.iteritems():
+            setattr(bundle.obj, attribute, objs)
+        bundle.obj.save()
+
+    def _save_documents(self, objs):
+        """
+        Saves documents with as few round trips as possible. New documents are
+        inserted in bulk per document class and changed documents are updated
+        in bulk per collection, all after they are validated. Unchanged documents
+        are skipped. Documents with custom ``save`` method or save signal receivers
+        (see ``has_custom_save``) or with primary key set before they were first
+        saved are saved one by one.
+
+        Errors of bulk writes are raised as ``NotUniqueError`` or
+        ``ValidationError``, after documents which were written are marked as
+        saved.
+        """
+
+        seen = set()
+        custom = []
+        inserts = {}
+        updates = {}
+
+        for obj in objs:
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+
+            if has_custom_save(type(obj)) or (obj._created and obj.pk is not None):
+                custom.append(obj)
+                continue
+
+            if obj._created:
+                obj.validate()
+                inserts.setdefault(type(obj), []).append(obj)
+                continue
 
-            for related_bundle in bundle.data[field_name]:
-                related_bundle.obj.save()
-                related_objs.append(related_bundle.obj)
+            set_data, unset_data = obj._delta()
+            if not set_data and not unset_data:
+                continue
 
-            setattr(bundle.obj, field_object.attribute, related_objs)
-            bundle.obj.save()
+            obj.validate()
+
+            update = {}
+            if set_data:
+                update['$set'] = set_data
+            if unset_data:
+                update['$unset'] = unset_data
+
+            # Shard key has to be in the query, like when saving
+            data = obj.to_mongo()
+            query = {'_id': data['_id']}
+            for key in obj._meta.get('shard_key', ()):
+                key = obj._db_field_map.get(key, key)
+                query[key] = data[key]
+
+            collection = obj._get_collection()
+            updates.setdefault(collection.full_name, (collection, []))[1].append((obj, query, update))
+
+        for obj in custom:
+            obj.save()
+
+        for document_class, class_objs in inserts.iteritems():
+            ids = queryset.QuerySet(document_class, document_class._get_collection()).insert(class_objs, load_bulk=False)
+            for obj, pk in zip(class_objs, ids):
+                obj.pk = pk
+                obj._created = False
+                obj._clear_changed_fields()
+
+        for collection, operations in updates.itervalues():
+            self._write_updates(collection, operations)
+
+    def _write_updates(self, collection, operations):
+        if not hasattr(collection, 'bulk_write') and not hasattr(collection, 'initialize_unordered_bulk_op'):
+            # Before PyMongo 2.7
+            for obj, query, update in operations:
+                try:
+                    collection.update(query, update)
+                except pymongo_errors.OperationFailure as ex:
+                    raise write_error(ex.code, unicode(ex))
+                obj._clear_changed_fields()
+            return
+
+        try:
+            if hasattr(collection, 'bulk_write'):
+                # PyMongo 3
+                collection.bulk_write([pymongo.UpdateOne(query, update) for obj, query, update in operations], ordered=False)
+            else:
+                # PyMongo 2.7+
+                bulk = collection.initialize_unordered_bulk_op()
+                for obj, query, update in operations:
+                    bulk.find(query).update_one(update)
+                bulk.execute()
+        except pymongo_errors.BulkWriteError as ex:
+            errors = ex.details.get('writeErrors') or [{'index': None, 'code': None, 'errmsg': unicode(ex)}]
+            # Unordered bulk writes all operations which do not fail
+            failed = set(error['index'] for error in errors)
+            for i, (obj, query, update) in enumerate(operations):
+                if i not in failed:
+                    obj._clear_changed_fields()
+            raise write_error(errors[0].get('code'), errors[0].get('errmsg'))
+
+        for obj, query, update in operations:
+            obj._clear_changed_fields()
 
     @classmethod
     def api_field_from_mongo_field(cls, f, default=tastypie_fields.CharField):
@@ -760,7 +1835,7 @@ class MongoEngineResource(resources.ModelResource):
         Update the object in original_bundle in-place using new_data.
         """
 
-        # TODO: Is this the place to use MongoDB atomic operations to update the document?
+        # Atomic updates without reading the document first are done in patch_detail, if enabled
 
         from tastypie.utils import dict_strip_unicode_keys
         original_bundle.data.update(**dict_strip_unicode_keys(new_data))
@@ -777,6 +1852,134 @@ class MongoEngineResource(resources.ModelResource):
         }
         return self.obj_update(bundle=original_bundle, **kwargs)
 
+    def patch_detail(self, request, **kwargs):
+        if getattr(self._meta, 'atomic_patch', False):
+            response = self._atomic_patch_detail(request, **kwargs)
+            if response is not None:
+                return response
+
+        return super(MongoEngineResource, self).patch_detail(request, **kwargs)
+
+    def _get_atomic_update(self, bundle):
+        """
+        Hydrates and validates only fields present in the bundle's data and
+        returns a raw update for them, or ``None`` if this is not possible.
+        """
+
+        object_class = self._meta.object_class
+        bundle = self.hydrate(bundle)
+
+        values = []
+        for field_name, field_object in self.fields.iteritems():
+            if field_object.instance_name not in bundle.data:
+                continue
+
+            if field_object.readonly or getattr(field_object, '_primary_key', False) or not field_object.attribute:
+                continue
+
+            # Related, embedded and nested fields need whole documents (embedded
+            # fields are related fields in Tastypie, but not marked as related)
+            if isinstance(field_object, tastypie_fields.RelatedField) or getattr(field_object, 'is_related', False) or field_object.attribute not in object_class._fields:
+                return None
+
+            setattr(bundle.obj, field_object.attribute, field_object.hydrate(bundle))
+
+            method = getattr(self, 'hydrate_%s' % field_name, None)
+            if method:
+                bundle = method(bundle)
+
+            value = getattr(bundle.obj, field_object.attribute, None)
+            if value is None and not (field_object.blank or field_object.null):
+                raise tastypie_exceptions.ApiFieldError("The '%s' field has no data and doesn't allow a default or null value." % field_object.instance_name)
+
+            values.append((object_class._fields[field_object.attribute], value))
+
+        if not values:
+            return None
+
+        update = {}
+        try:
+            for document_field, value in values:
+                if value is None:
+                    update.setdefault('$unset', {})[document_field.db_field] = 1
+                else:
+                    getattr(document_field, '_validate', document_field.validate)(value)
+                    update.setdefault('$set', {})[document_field.db_field] = document_field.to_mongo(value)
+        except mongoengine.ValidationError as ex:
+            raise exceptions.ValidationError(ex.message)
+
+        return update
+
+    def _can_authorize_atomic_update(self):
+        # Only authorization which does not check the stored
+        # document in update_detail can be used without reading it
+        update_detail = getattr(type(self._meta.authorization).update_detail, 'im_func', None)
+        if update_detail is not tastypie_authorization.Authorization.update_detail.im_func:
+            return False
+        return type(self).authorized_update_detail.im_func is resources.Resource.authorized_update_detail.im_func
+
+    def _atomic_patch_detail(self, request, **kwargs):
+        """
+        Updates the document with one ``find_one_and_update`` (``find_and_modify``
+        with PyMongo 2) without reading it first. Only supplied fields are hydrated,
+        validated and written.
+
+        Returns ``None`` if the request cannot be processed in this way.
+        """
+
+        object_class = self._meta.object_class
+        if getattr(self._meta, 'polymorphic', {}) or not issubclass(object_class, mongoengine.Document):
+            return None
+
+        # Document's own save, clean or save signals would be bypassed
+        if has_custom_save(object_class) or overrides_document_method(object_class, 'clean'):
+            return None
+
+        if not self._can_authorize_atomic_update():
+            return None
+
+        request = resources.convert_post_to_patch(request)
+        deserialized = self.deserialize(request, request.body, format=request.META.get('CONTENT_TYPE', 'application/json'))
+        deserialized = self.alter_deserialized_detail_data(request, deserialized)
+
+        bundle = self.build_bundle(data=utils.dict_strip_unicode_keys(deserialized), request=request)
+        update = self._get_atomic_update(bundle)
+        if update is None:
+            return None
+
+        # Validation gets only supplied data
+        self.is_valid(bundle)
+        if bundle.errors:
+            raise tastypie_exceptions.ImmediateHttpResponse(response=self.error_response(request, bundle.errors))
+
+        qs = self.authorized_update_list(self.get_object_list(request), bundle)
+        if not isinstance(qs, queryset.QuerySet):
+            return None
+        qs = qs.filter(**self.remove_api_resource_names(kwargs))
+
+        # $where cannot be used with find_and_modify
+        if getattr(qs, '_where_clause', None):
+            return None
+
+        collection = qs._collection
+        if hasattr(collection, 'find_one_and_update'):
+            data = collection.find_one_and_update(qs._query, update, return_document=pymongo.ReturnDocument.AFTER)
+        else:
+            data = collection.find_and_modify(qs._query, update, new=True)
+
+        if data is None:
+            return http.HttpNotFound()
+
+        self._invalidate_bookmarks()
+
+        if not self._meta.always_return_data:
+            return http.HttpAccepted()
+
+        bundle = self.build_bundle(obj=self._meta.object_class._from_son(data), request=request)
+        bundle = self.full_dehydrate(bundle)
+        bundle = self.alter_detail_data_to_serialize(request, bundle)
+        return self.create_response(request, bundle, response_class=http.HttpAccepted)
+
 
 class MongoEngineListResource(MongoEngineResource):
     """
@@ -788,6 +1991,8 @@ class MongoEngineListResource(MongoEngineResource):
 
         self.instance = None
         self.parent = self._parent(api_name)
+        self.use_aggregation = False
+        self._embedded_positions = None
 
         # Validate the fields and set primary key if needed
         for field_name, field in self._meta.object_class._fields.iteritems():
@@ -805,14 +2010,27 @@ class MongoEngineListResource(MongoEngineResource):
         filters = self.remove_api_resource_names(kwargs)
 
         try:
-            return self.parent.cached_obj_get(bundle=bundle, **filters)
+            if not self.use_aggregation:
+                return self.parent.cached_obj_get(bundle=bundle, **filters)
+
+            # Embedded list is queried with aggregation, so we do not load it.
+            # Such incomplete document is not cached.
+            return self.parent.obj_get(bundle=bundle, exclude_fields=(self.attribute,), **filters)
         except (queryset.DoesNotExist, exceptions.ObjectDoesNotExist):
             raise tastypie_exceptions.ImmediateHttpResponse(response=http.HttpNotFound())
 
+    def _can_use_aggregation(self, request):
+        if not getattr(self.parent._meta, 'aggregate_embedded_lists', False) or request.method != 'GET':
+            return False
+
+        field = self.parent._meta.object_class._fields.get(self.attribute)
+        return isinstance(getattr(field, 'field', None), mongoengine.EmbeddedDocumentField)
+
     def dispatch(self, request_type, request, **kwargs):
         subresource_pk = kwargs.pop('subresource_pk', None)
 
         bundle = self.build_bundle(request=request)
+        self.use_aggregation = self._can_use_aggregation(request)
         self.instance = self._safe_get(bundle, **kwargs)
 
         # We use subresource pk as pk from now on
@@ -835,22 +2053,16 @@ class MongoEngineListResource(MongoEngineResource):
         if not self.instance:
             return ListQuerySet()
 
-        pk_field = getattr(self._meta, 'id_field', None)
+        if self.use_aggregation:
+            return AggregatedListQuerySet(self.instance, self.attribute, getattr(self._meta, 'id_field', None))
 
-        if pk_field is not None:
-            object_list = []
-            for obj in getattr(self.instance, self.attribute):
-                pk = getattr(obj, pk_field)
-                obj.__class__.pk = tastypie_mongoengine_fields.link_property(pk_field)
-                object_list.append((unicode(pk), obj))
-            return ListQuerySet(object_list)
+        object_list = getattr(self.instance, self.attribute)
+        pk_field = getattr(self._meta, 'id_field', None)
 
-        else:
-            def add_index(index, obj):
-                obj.pk = index
-                return obj
+        if pk_field is None:
+            return EmbeddedListQuerySet(object_list)
 
-            return ListQuerySet([(unicode(index), add_index(index, obj)) for index, obj in enumerate(getattr(self.instance, self.attribute))])
+        return EmbeddedListQuerySet(object_list, pk_field, lambda key: self._find_embedded_position(object_list, pk_field, key))
 
     def obj_create(self, bundle, **kwargs):
         try:
@@ -873,7 +2085,12 @@ class MongoEngineListResource(MongoEngineResource):
 
             self.save_related(bundle)
 
-            self.instance.save()
+            if self._can_update_atomically():
+                bundle.obj.validate()
+                self._push_embedded_document(bundle.obj)
+            else:
+                self.instance.save()
+                self.parent._invalidate_bookmarks()
 
             m2m_bundle = self.hydrate_m2m(bundle)
             self.save_m2m(m2m_bundle)
@@ -881,14 +2098,138 @@ class MongoEngineListResource(MongoEngineResource):
         except mongoengine.ValidationError as ex:
             raise exceptions.ValidationError(ex.message)
 
-    def find_embedded_document(self, objects, pk_field, pk):
-        # TODO: Would it be faster to traverse in reversed direction? Because probably last elements are fetched more often in practice?
-        # TODO: Should we cache information about mappings between IDs and elements?
-        for i, obj in enumerate(objects):
-            if getattr(obj, pk_field) == pk:
-                return i
+    def _can_update_atomically(self):
+        return isinstance(self.instance, mongoengine.Document) and self.instance.pk is not None
+
+    def _get_list_field(self):
+        return self.instance._fields[self.attribute]
+
+    def _to_mongo_element(self, obj):
+        field = self._get_list_field().field
+        if field is None:
+            return obj.to_mongo()
+        return field.to_mongo(obj)
+
+    def _update_instance(self, update, query=None):
+        """
+        Atomically applies a raw update to the parent document in the database,
+        if it matches the raw query as well. If it does not match the query,
+        the list was changed concurrently and ``409 Conflict`` is returned.
+        """
+
+        qs = self.instance._qs.filter(__raw__=query or {}, **self.instance._object_key)
+
+        # Number of updated documents is not known with unacknowledged writes
+        if qs.update_one(__raw__=update) == 0:
+            if query:
+                raise tastypie_exceptions.ImmediateHttpResponse(response=http.HttpConflict())
+            raise tastypie_exceptions.NotFound("A document instance matching the provided arguments could not be found.")
+
+        self.parent._invalidate_bookmarks()
+
+    def _push_embedded_document(self, obj):
+        """
+        Appends the embedded document to the list in the database with ``$push``,
+        limiting the length of the list if configured for the list.
+        """
+
+        field = self._get_list_field()
+        value = self._to_mongo_element(obj)
+
+        list_slice = getattr(self.parent._meta, 'embedded_list_slices', {}).get(self.attribute)
+        if list_slice is not None:
+            value = {'$each': [value], '$slice': list_slice}
+
+        self._update_instance({'$push': {field.db_field: value}})
 
-        raise IndexError("Embedded document with primary key '%s' not found." % pk)
+    def _set_embedded_document(self, position, original, obj):
+        """
+        Writes fields of the embedded document which differ from the original
+        (as stored in the database) with a positional ``$set`` and ``$unset``,
+        only if the original is still stored in the list.
+        """
+
+        field = self._get_list_field()
+        value = self._to_mongo_element(obj)
+        pk_field = getattr(self._meta, 'id_field', None)
+
+        if pk_field is None:
+            path = '%s.%s' % (field.db_field, position)
+            # Fails if another document is at the position now (or none, when
+            # $set would pad the list with nulls)
+            query = {path: original}
+        else:
+            path = '%s.$' % field.db_field
+            query = {field.db_field: original}
+
+        update = {}
+        for key, item in value.iteritems():
+            if key not in original or original[key] != item:
+                update.setdefault('$set', {})['%s.%s' % (path, key)] = item
+        for key in original:
+            if key not in value:
+                update.setdefault('$unset', {})['%s.%s' % (path, key)] = 1
+
+        if update:
+            self._update_instance(update, query)
+
+    def _pull_embedded_document(self, position, obj):
+        """
+        Removes the embedded document from the list in the database with ``$pull``.
+
+        Documents with ``id_field`` are matched by it. Otherwise removal takes two
+        updates, as ``$pull`` with a document would remove all elements which
+        contain its fields: the document is first replaced with ``null`` at its
+        position, only if it is still stored there, and then nulls are pulled.
+        Between the two updates readers can see ``null`` in the list.
+        """
+
+        field = self._get_list_field()
+        pk_field = getattr(self._meta, 'id_field', None)
+        value = self._to_mongo_element(obj)
+
+        if pk_field is not None:
+            pk_db_field = obj._fields[pk_field].db_field
+            self._update_instance({'$pull': {field.db_field: {pk_db_field: value.get(pk_db_field)}}})
+            return
+
+        path = '%s.%s' % (field.db_field, position)
+        # Fails if the list was changed concurrently and the document is not there anymore
+        self._update_instance({'$unset': {path: 1}}, {path: value})
+        self._update_instance({'$pull': {field.db_field: None}})
+
+    def _get_embedded_positions(self, objects, pk_field, rebuild=False):
+        """
+        Returns a mapping between stringified primary keys of embedded documents
+        and their positions in the list. The mapping is reused while it is the
+        same list of the same length.
+
+        Keys are compared as ``unicode`` strings, like primary keys from URIs.
+        """
+
+        if rebuild or self._embedded_positions is None or self._embedded_positions[0] is not objects or self._embedded_positions[1] != len(objects):
+            positions = {}
+            for i, obj in enumerate(objects):
+                positions.setdefault(unicode(getattr(obj, pk_field)), i)
+            self._embedded_positions = (objects, len(objects), positions)
+
+        return self._embedded_positions[2]
+
+    def _find_embedded_position(self, objects, pk_field, key):
+        i = self._get_embedded_positions(objects, pk_field).get(key)
+
+        # List could be changed in place after the mapping was made, so we check
+        # the hit, but we do not rebuild the mapping on every miss
+        if i is not None and unicode(getattr(objects[i], pk_field)) != key:
+            i = self._get_embedded_positions(objects, pk_field, rebuild=True).get(key)
+
+        return i
+
+    def find_embedded_document(self, objects, pk_field, pk):
+        i = self._find_embedded_position(objects, pk_field, unicode(pk))
+        if i is None:
+            raise IndexError("Embedded document with primary key '%s' not found." % pk)
+        return i
 
     # TODO: Use skip_errors?
     def obj_update(self, bundle, skip_errors=False, **kwargs):
@@ -899,19 +2240,30 @@ class MongoEngineListResource(MongoEngineResource):
                 except (queryset.DoesNotExist, exceptions.ObjectDoesNotExist):
                     raise tastypie_exceptions.NotFound("A document instance matching the provided arguments could not be found.")
 
+            atomic = self._can_update_atomically()
+            if atomic:
+                # We compare the document before and after hydration to know what to write
+                original = self._to_mongo_element(bundle.obj)
+
             bundle = self.full_hydrate(bundle)
 
             object_list = getattr(self.instance, self.attribute)
             pk_field = getattr(self._meta, 'id_field', None)
 
             if pk_field is None:
-                object_list[bundle.obj.pk] = bundle.obj
+                position = bundle.obj.pk
             else:
-                object_list[self.find_embedded_document(object_list, pk_field, bundle.obj.pk)] = bundle.obj
+                position = self.find_embedded_document(object_list, pk_field, bundle.obj.pk)
+            object_list[position] = bundle.obj
 
             self.save_related(bundle)
 
-            self.instance.save()
+            if atomic:
+                bundle.obj.validate()
+                self._set_embedded_document(position, original, bundle.obj)
+            else:
+                self.instance.save()
+                self.parent._invalidate_bookmarks()
 
             m2m_bundle = self.hydrate_m2m(bundle)
             self.save_m2m(m2m_bundle)
@@ -932,16 +2284,24 @@ class MongoEngineListResource(MongoEngineResource):
         pk_field = getattr(self._meta, 'id_field', None)
 
         if pk_field is None:
-            object_list.pop(obj.pk)
+            position = obj.pk
         else:
-            object_list.pop(self.find_embedded_document(object_list, pk_field, obj.pk))
+            position = self.find_embedded_document(object_list, pk_field, obj.pk)
+
+        atomic = self._can_update_atomically()
+        if atomic:
+            self._pull_embedded_document(position, obj)
+
+        object_list.pop(position)
 
         # Make sure to delete FileField files
         for fieldname, field in obj._fields.items():
             if isinstance(field, mongoengine_fields.FileField):
                 obj[fieldname].delete()
 
-        self.instance.save()
+        if not atomic:
+            self.instance.save()
+            self.parent._invalidate_bookmarks()
 
     def detail_uri_kwargs(self, bundle_or_obj):
         if isinstance(bundle_or_obj, tastypie_bundle.Bundle):
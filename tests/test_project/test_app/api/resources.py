@@ -126,6 +126,7 @@ class CustomerResource(resources.MongoEngineResource):
         queryset = documents.Customer.objects.all()
         allowed_methods = ('get', 'post', 'put', 'patch', 'delete')
         authorization = tastypie_authorization.Authorization()
+        paginator_class = paginator.Paginator
 
 
 class EmbeddedCommentResource(resources.MongoEngineResource):
@@ -167,6 +168,22 @@ class DocumentWithIDResource(resources.MongoEngineResource):
         authorization = tastypie_authorization.Authorization()
 
 
+class EmbeddedPersonWithIDResource(resources.MongoEngineResource):
+    class Meta:
+        object_class = documents.EmbeddedPersonWithID
+        allowed_methods = ('get', 'post', 'put', 'patch', 'delete')
+        authorization = tastypie_authorization.Authorization()
+
+
+class EmbeddedListWithIDFieldTestResource(resources.MongoEngineResource):
+    embeddedlist = fields.EmbeddedListField(of='test_project.test_app.api.resources.EmbeddedPersonWithIDResource', attribute='embeddedlist', full=True, null=True)
+
+    class Meta:
+        queryset = documents.EmbeddedListWithIDFieldTest.objects.all()
+        allowed_methods = ('get', 'post', 'put', 'patch', 'delete')
+        authorization = tastypie_authorization.Authorization()
+
+
 class EmbeddedListInEmbeddedDocTestResource(resources.MongoEngineResource):
     post = fields.EmbeddedDocumentField(embedded='test_project.test_app.api.resources.EmbeddedPostResource', attribute='post')
 
@@ -211,6 +228,29 @@ class EmbeddedListFieldTestResource(resources.MongoEngineResource):
         ordering = ('id', 'embeddedlist')
 
 
+class AggregatedEmbeddedPersonResource(resources.MongoEngineResource):
+    class Meta:
+        object_class = documents.EmbeddedPerson
+        allowed_methods = ('get', 'post', 'put', 'patch', 'delete')
+        authorization = tastypie_authorization.Authorization()
+        ordering = ('name',)
+        filtering = {
+            'name': ('exact', 'startswith'),
+            'optional': ('exact',),
+        }
+        paginator_class = paginator.Paginator
+
+
+class EmbeddedListFieldAggregatedTestResource(resources.MongoEngineResource):
+    embeddedlist = fields.EmbeddedListField(of='test_project.test_app.api.resources.AggregatedEmbeddedPersonResource', attribute='embeddedlist', full=True, null=True)
+
+    class Meta:
+        queryset = documents.EmbeddedListFieldTest.objects.all()
+        allowed_methods = ('get', 'post', 'put', 'patch', 'delete')
+        authorization = tastypie_authorization.Authorization()
+        aggregate_embedded_lists = True
+
+
 class EmbeddedListFieldNonFullTestResource(resources.MongoEngineResource):
     embeddedlist = fields.EmbeddedListField(of='test_project.test_app.api.resources.EmbeddedPersonResource', attribute='embeddedlist', full=False, null=True)
 
@@ -85,6 +85,16 @@ class DocumentWithID(InheritableDocument):
     comments = mongoengine.ListField(mongoengine.EmbeddedDocumentField(EmbeddedCommentWithID))
 
 
+class EmbeddedPersonWithID(InheritableEmbeddedDocument):
+    id = mongoengine.ObjectIdField(primary_key=True, default=lambda: bson.ObjectId())
+    name = mongoengine.StringField(max_length=200, required=True)
+    optional = mongoengine.StringField(max_length=200, required=False)
+
+
+class EmbeddedListWithIDFieldTest(InheritableDocument):
+    embeddedlist = mongoengine.ListField(mongoengine.EmbeddedDocumentField(EmbeddedPersonWithID))
+
+
 class EmbeddedListInEmbeddedDocTest(InheritableDocument):
     post = mongoengine.EmbeddedDocumentField(EmbeddedPost)
 
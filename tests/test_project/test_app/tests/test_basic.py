@@ -1,15 +1,18 @@
 from __future__ import with_statement
 
+import datetime
 import urlparse
 
 from django.core import exceptions, urlresolvers
 from django.test import client, utils
 import json
 
+from pymongo import collection as pymongo_collection
+
 import tastypie
-from tastypie import authorization as tastypie_authorization
+from tastypie import authorization as tastypie_authorization, exceptions as tastypie_exceptions
 
-from tastypie_mongoengine import resources as tastypie_mongoengine_resources, test_runner
+from tastypie_mongoengine import fields as tastypie_mongoengine_fields, paginator, resources as tastypie_mongoengine_resources, test_runner
 
 from test_project.test_app import documents
 from test_project.test_app.api import resources
@@ -806,6 +809,125 @@ class BasicTest(test_runner.MongoEngineTestCase):
 
         self.assertEqual(len(response['embeddedlist']), 2)
 
+    def test_embeddedlist_delete_superset(self):
+        embeddedlistfieldtest = documents.EmbeddedListFieldTest(embeddedlist=[
+            documents.EmbeddedPerson(name='Embedded person 1'),
+            documents.EmbeddedPerson(name='Embedded person 1', optional='Optional'),
+            documents.EmbeddedPerson(name='Embedded person 2'),
+        ])
+        embeddedlistfieldtest.save()
+
+        mainresource_uri = self.resourceDetailURI('embeddedlistfieldtest', embeddedlistfieldtest.pk)
+
+        # Only the element itself is removed, not elements which contain its fields
+        response = self.c.delete('%sembeddedlist/0/' % mainresource_uri)
+        self.assertEqual(response.status_code, 204)
+
+        embeddedlistfieldtest = documents.EmbeddedListFieldTest.objects.get(pk=embeddedlistfieldtest.pk)
+        self.assertEqual([(person.name, person.optional) for person in embeddedlistfieldtest.embeddedlist], [('Embedded person 1', 'Optional'), ('Embedded person 2', None)])
+
+    def test_embeddedlist_aggregation(self):
+        embeddedlistfieldtest = documents.EmbeddedListFieldTest(embeddedlist=[documents.EmbeddedPerson(name='Embedded person %s' % i, optional='%s' % (i % 2)) for i in range(6)])
+        embeddedlistfieldtest.save()
+
+        mainresource_uri = self.resourceDetailURI('embeddedlistfieldaggregatedtest', embeddedlistfieldtest.pk)
+        list_uri = '%sembeddedlist/' % mainresource_uri
+
+        # Filtered
+        response = self.c.get(list_uri, {'optional': '1'})
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.content)
+
+        self.assertEqual([person['name'] for person in response['objects']], ['Embedded person 1', 'Embedded person 3', 'Embedded person 5'])
+        self.assertEqual(response['meta']['total_count'], 3)
+
+        # Ordered and paginated, with positions in the whole list
+        response = self.c.get(list_uri, {'order_by': '-name', 'offset': 1, 'limit': 2})
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.content)
+
+        self.assertEqual([person['name'] for person in response['objects']], ['Embedded person 4', 'Embedded person 3'])
+        self.assertEqual([person['resource_uri'] for person in response['objects']], ['%s4/' % list_uri, '%s3/' % list_uri])
+        self.assertEqual(response['meta']['total_count'], 6)
+        self.assertTrue(response['meta']['next'])
+
+        response = self.c.get('%s2/' % list_uri)
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.content)
+
+        self.assertEqual(response['name'], 'Embedded person 2')
+
+        response = self.c.get('%s6/' % list_uri)
+        self.assertEqual(response.status_code, 404)
+
+        # The document itself is loaded without the list
+        resource = resources.EmbeddedListFieldAggregatedTestResource()
+        document = resource.obj_get(resource.build_bundle(), exclude_fields=('embeddedlist',), pk=embeddedlistfieldtest.pk)
+        self.assertEqual(document.pk, embeddedlistfieldtest.pk)
+        self.assertEqual(document.embeddedlist, [])
+
+    def test_embeddedlist_atomic_updates(self):
+        embeddedlistwithidfieldtest = documents.EmbeddedListWithIDFieldTest()
+        embeddedlistwithidfieldtest.save()
+
+        mainresource_uri = self.resourceDetailURI('embeddedlistwithidfieldtest', embeddedlistwithidfieldtest.pk)
+        collection = documents.EmbeddedListWithIDFieldTest._get_collection()
+        id_key = documents.EmbeddedPersonWithID._fields['id'].db_field
+
+        def stored_list():
+            return [dict((key, value) for key, value in person.iteritems() if key != '_cls') for person in collection.find_one({'_id': embeddedlistwithidfieldtest.pk})['embeddedlist']]
+
+        # New embedded documents are pushed
+        person_uris = []
+        for i in range(2):
+            response = self.c.post('%sembeddedlist/' % mainresource_uri, '{"name": "Embedded person %d", "optional": "Optional"}' % (i + 1), content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+            person_uris.append(self.fullURItoAbsoluteURI(response['location']))
+
+        stored = stored_list()
+        self.assertEqual([(person['name'], person['optional']) for person in stored], [('Embedded person 1', 'Optional'), ('Embedded person 2', 'Optional')])
+        person1_id, person2_id = [person[id_key] for person in stored]
+
+        # Changed field is set
+        response = self.c.patch(person_uris[0], '{"optional": "Changed"}', content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+
+        self.assertEqual(stored_list(), [
+            {id_key: person1_id, 'name': 'Embedded person 1', 'optional': 'Changed'},
+            {id_key: person2_id, 'name': 'Embedded person 2', 'optional': 'Optional'},
+        ])
+
+        # Removed field is unset
+        response = self.c.put(person_uris[0], '{"name": "Embedded person 1", "optional": null}', content_type='application/json')
+        self.assertEqual(response.status_code, 204)
+
+        self.assertEqual(stored_list(), [
+            {id_key: person1_id, 'name': 'Embedded person 1'},
+            {id_key: person2_id, 'name': 'Embedded person 2', 'optional': 'Optional'},
+        ])
+
+        # Embedded document which was changed concurrently is not overwritten
+        resource = resources.EmbeddedListWithIDFieldTestResource().fields['embeddedlist'].to_class()
+        resource.instance = documents.EmbeddedListWithIDFieldTest.objects.get(pk=embeddedlistwithidfieldtest.pk)
+        person = resource.instance.embeddedlist[1]
+        original = resource._to_mongo_element(person)
+        collection.update({'_id': embeddedlistwithidfieldtest.pk}, {'$set': {'embeddedlist.1.optional': 'Concurrent'}})
+        person.name = 'Changed'
+
+        with self.assertRaises(tastypie_exceptions.ImmediateHttpResponse) as cm:
+            resource._set_embedded_document(1, original, person)
+        self.assertEqual(cm.exception.response.status_code, 409)
+
+        self.assertEqual(stored_list()[1], {id_key: person2_id, 'name': 'Embedded person 2', 'optional': 'Concurrent'})
+
+        # Deleted embedded document is pulled
+        response = self.c.delete(person_uris[0])
+        self.assertEqual(response.status_code, 204)
+
+        self.assertEqual(stored_list(), [
+            {id_key: person2_id, 'name': 'Embedded person 2', 'optional': 'Concurrent'},
+        ])
+
     def test_referencedlist(self):
         response = self.c.get(self.resourceListURI('referencedlistfieldtest'))
         self.assertEqual(response.status_code, 200)
@@ -867,6 +989,248 @@ class BasicTest(test_runner.MongoEngineTestCase):
 
         self.assertEqual(response['name'], 'Person 1')
 
+    def test_referencedlist_save_documents(self):
+        person1 = documents.Person(name='Person 1')
+        person1.save()
+        person1_uri = self.resourceDetailURI('person', person1.pk)
+
+        # New referenced documents are inserted
+        response = self.c.post(self.resourceListURI('referencedlistfieldtest'), '{"referencedlist": ["' + person1_uri + '", {"name": "Person 2"}, {"name": "Person 3", "optional": "Optional"}]}', content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+        mainresource_uri = self.fullURItoAbsoluteURI(response['location'])
+
+        referencedlistfieldtest = documents.ReferencedListFieldTest.objects.get(pk=self.resourcePK(mainresource_uri))
+        self.assertEqual([(person.name, person.optional) for person in referencedlistfieldtest.referencedlist], [('Person 1', None), ('Person 2', None), ('Person 3', 'Optional')])
+        self.assertEqual(referencedlistfieldtest.referencedlist[0].pk, person1.pk)
+        self.assertEqual(documents.Person.objects.count(), 3)
+
+        person2, person3 = referencedlistfieldtest.referencedlist[1:]
+
+        # Unchanged referenced documents are kept as they are
+        response = self.c.put(mainresource_uri, '{"referencedlist": ["' + self.resourceDetailURI('person', person3.pk) + '", "' + person1_uri + '"]}', content_type='application/json')
+        self.assertEqual(response.status_code, 204)
+
+        referencedlistfieldtest = documents.ReferencedListFieldTest.objects.get(pk=referencedlistfieldtest.pk)
+        self.assertEqual([person.pk for person in referencedlistfieldtest.referencedlist], [person3.pk, person1.pk])
+        self.assertEqual(documents.Person.objects.get(pk=person3.pk).optional, 'Optional')
+
+        # Changed referenced documents are updated and new ones inserted, and the document is saved once
+        person2.optional = 'Changed'
+        person4 = documents.Person(name='Person 4')
+
+        resource = resources.ReferencedListFieldTestResource()
+        bundle = resource.build_bundle(obj=referencedlistfieldtest)
+        bundle.data['referencedlist'] = [resource.build_bundle(obj=person2), resource.build_bundle(obj=person4), resource.build_bundle(obj=person2)]
+
+        saves = []
+        save = referencedlistfieldtest.save
+
+        def counted_save(*args, **kwargs):
+            saves.append(1)
+            return save(*args, **kwargs)
+        referencedlistfieldtest.save = counted_save
+
+        person_saves = []
+        person_save = documents.Person.save
+
+        def counted_person_save(self, *args, **kwargs):
+            person_saves.append(1)
+            return person_save(self, *args, **kwargs)
+
+        # Bulk saving is enabled with bulk_save_related
+        resource._meta.bulk_save_related = True
+        try:
+            resource.save_m2m(bundle)
+
+            # Documents with custom save method are saved one by one
+            documents.Person.save = counted_person_save
+            try:
+                resource._save_documents([documents.Person(name='Person 5')])
+            finally:
+                documents.Person.save = person_save
+        finally:
+            del resource._meta.bulk_save_related
+
+        self.assertEqual(len(saves), 1)
+        self.assertEqual(len(person_saves), 1)
+
+        self.assertEqual(documents.Person.objects.get(pk=person2.pk).optional, 'Changed')
+        self.assertEqual(documents.Person.objects.get(pk=person4.pk).name, 'Person 4')
+
+        self.assertEqual(documents.Person.objects.count(), 5)
+
+        referencedlistfieldtest = documents.ReferencedListFieldTest.objects.get(pk=referencedlistfieldtest.pk)
+        self.assertEqual([person.pk for person in referencedlistfieldtest.referencedlist], [person2.pk, person4.pk, person2.pk])
+
+        # By default, related documents are saved one by one, each once
+        person2.optional = 'Changed again'
+        bundle.data['referencedlist'] = [resource.build_bundle(obj=person2), resource.build_bundle(obj=person2)]
+
+        documents.Person.save = counted_person_save
+        try:
+            resource.save_m2m(bundle)
+        finally:
+            documents.Person.save = person_save
+
+        self.assertEqual(len(person_saves), 2)
+        self.assertEqual(documents.Person.objects.get(pk=person2.pk).optional, 'Changed again')
+
+    def test_referenced_documents(self):
+        persons = [documents.Person(name='Person %s' % i) for i in range(3)]
+        for person in persons:
+            person.save()
+
+        referencedlist = documents.ReferencedListFieldTest(referencedlist=[persons[2], persons[0], persons[1]])
+        referencedlist.save()
+        persons[1].delete()
+
+        referencedlist = documents.ReferencedListFieldTest.objects.get(pk=referencedlist.pk)
+        field = resources.ReferencedListFieldTestResource().fields['referencedlist']
+
+        self.assertEqual([person.name for person in field.get_referenced_documents(referencedlist)], ['Person 2', 'Person 0'])
+
+    def test_reference_stubs(self):
+        persons = [documents.Person(name='Person %s' % i) for i in range(2)]
+        for person in persons:
+            person.save()
+
+        referencedlist = documents.ReferencedListFieldTest(referencedlist=persons)
+        referencedlist.save()
+
+        referencedlist = documents.ReferencedListFieldTest.objects.get(pk=referencedlist.pk)
+        field = resources.ReferencedListFieldNonFullTestResource().fields['referencedlist']
+        stubs = field.get_reference_stubs(referencedlist._fields['referencedlist'].field, referencedlist._data['referencedlist'])
+
+        self.assertEqual([stub.pk for stub in stubs], [person.pk for person in persons])
+        self.assertEqual([stub.name for stub in stubs], [None, None])
+
+        # Stubs cannot be used when resource URIs do not use the primary key
+        detail_uri_name = resources.PersonResource._meta.detail_uri_name
+        try:
+            resources.PersonResource._meta.detail_uri_name = 'name'
+            self.assertEqual(field.get_reference_stubs(referencedlist._fields['referencedlist'].field, referencedlist._data['referencedlist']), None)
+        finally:
+            resources.PersonResource._meta.detail_uri_name = detail_uri_name
+
+        response = self.c.get(self.resourceListURI('referencedlistfieldnonfulltest'))
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.content)
+
+        self.assertEqual([self.resourcePK(uri) for uri in response['objects'][0]['referencedlist']], [str(person.pk) for person in persons])
+
+        # Polymorphic resource URIs need classes of referenced documents
+        field = resources.ContactGroupResource().fields['contacts']
+        self.assertEqual(field.get_reference_stubs(documents.ContactGroup._fields['contacts'].field, [persons[0].pk]), None)
+
+    def test_resources_from_uris(self):
+        individual = documents.Individual(name='Individual 1', phone='000-000000')
+        individual.save()
+        company = documents.Company(corporate_name='Company 1', phone='000-000000')
+        company.save()
+
+        individual_uri = self.resourceDetailURI('individual', individual.pk)
+        company_uri = self.resourceDetailURI('company', company.pk)
+
+        field = resources.ContactGroupResource().fields['contacts']
+        fk_resource = field.to_class()
+        bundles = field.resources_from_uris(fk_resource, [individual_uri, company_uri, individual_uri])
+
+        self.assertEqual(bundles[individual_uri].obj.name, 'Individual 1')
+        self.assertEqual(bundles[company_uri].obj.corporate_name, 'Company 1')
+
+        with self.assertRaises(tastypie_exceptions.ApiFieldError):
+            field.resources_from_uris(fk_resource, [self.resourceDetailURI('individual', company.pk)])
+
+        field.trust_uris = True
+        bundles = field.resources_from_uris(fk_resource, [individual_uri, company_uri])
+
+        self.assertTrue(isinstance(bundles[individual_uri].obj, documents.Individual))
+        self.assertEqual(bundles[individual_uri].obj.pk, individual.pk)
+        self.assertEqual(bundles[individual_uri].obj.name, None)
+        self.assertTrue(isinstance(bundles[company_uri].obj, documents.Company))
+        self.assertEqual(bundles[company_uri].obj.pk, company.pk)
+
+        # Documents given by trusted URIs cannot be shown in full
+        with self.assertRaises(ValueError):
+            tastypie_mongoengine_fields.ReferencedListField(of='test_project.test_app.api.resources.ContactResource', attribute='contacts', full=True, trust_uris=True)
+
+        class NoReadDetailAuthorization(tastypie_authorization.Authorization):
+            def read_detail(self, object_list, bundle):
+                return False
+
+        field.trust_uris = False
+        authorization = resources.IndividualResource._meta.authorization
+        try:
+            resources.IndividualResource._meta.authorization = NoReadDetailAuthorization()
+            with self.assertRaises(tastypie_exceptions.ImmediateHttpResponse):
+                field.resources_from_uris(fk_resource, [individual_uri])
+        finally:
+            resources.IndividualResource._meta.authorization = authorization
+
+    def test_get_via_uri(self):
+        self.assertEqual(resources.ContactResource._resources_by_name, {
+            'contact': resources.ContactResource,
+            'individual': resources.IndividualResource,
+            'company': resources.CompanyResource,
+            'unregisteredcompany': resources.UnregisteredCompanyResource,
+        })
+
+        individual = documents.Individual(name='Individual 1', phone='000-000000')
+        individual.save()
+
+        individual_uri = self.resourceDetailURI('individual', individual.pk)
+
+        for i in range(2):
+            obj = resources.ContactResource().get_via_uri(individual_uri)
+            self.assertTrue(isinstance(obj, documents.Individual))
+            self.assertEqual(obj.pk, individual.pk)
+            self.assertIn((None, urlresolvers.get_script_prefix(), individual_uri), tastypie_mongoengine_resources._resolved_uris)
+
+        # URIs are resolved again with URLconf of the request
+        urlresolvers.set_urlconf('test_project.urls')
+        try:
+            obj = resources.ContactResource().get_via_uri(individual_uri)
+        finally:
+            urlresolvers.set_urlconf(None)
+        self.assertEqual(obj.pk, individual.pk)
+        self.assertIn(('test_project.urls', urlresolvers.get_script_prefix(), individual_uri), tastypie_mongoengine_resources._resolved_uris)
+
+        with self.assertRaises(tastypie_exceptions.NotFound):
+            resources.ContactResource().get_via_uri('/invalid/')
+
+    def test_prefetch_references(self):
+        for i in range(3):
+            person = documents.Person(name='Person %s' % i)
+            person.save()
+            documents.Customer(person=person).save()
+
+        customers = list(documents.Customer.objects.all())
+        resources.CustomerResource().prefetch_references(customers)
+
+        for customer in customers:
+            self.assertTrue(isinstance(customer._data['person'], documents.Person))
+        self.assertEqual(sorted(customer.person.name for customer in customers), ['Person 0', 'Person 1', 'Person 2'])
+
+        # Documents on the page are prefetched together
+        prefetched = []
+        prefetch_references = resources.CustomerResource.prefetch_references
+
+        def counted_prefetch_references(self, objs, depth=None):
+            prefetched.append(len(objs))
+            return prefetch_references(self, objs, depth)
+
+        resources.CustomerResource.prefetch_references = counted_prefetch_references
+        try:
+            response = self.c.get(self.resourceListURI('customer'))
+        finally:
+            resources.CustomerResource.prefetch_references = prefetch_references
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.content)
+
+        self.assertEqual(prefetched, [3])
+        self.assertEqual(sorted(customer['person']['name'] for customer in response['objects']), ['Person 0', 'Person 1', 'Person 2'])
+
     def test_referencedlistnonfull(self):
         response = self.c.get(self.resourceListURI('referencedlistfieldnonfulltest'))
         self.assertEqual(response.status_code, 200)
@@ -1175,6 +1539,27 @@ class BasicTest(test_runner.MongoEngineTestCase):
         self.assertEqual(unreg_company_obj['resource_type'], 'unregisteredcompany')
         self.assertEqual(unreg_company_obj['corporate_name'], 'Unreg company')
 
+    def test_polymorphic_mixed_referencedlist(self):
+        individual1 = documents.Individual(name='Individual 1', phone='000-000000')
+        individual1.save()
+        company = documents.Company(corporate_name='Company 1', phone='000-000000')
+        company.save()
+        individual2 = documents.Individual(name='Individual 2', phone='000-000000')
+        individual2.save()
+
+        contactgroup = documents.ContactGroup(contacts=[individual1, company, individual2])
+        contactgroup.save()
+
+        response = self.c.get(self.resourceDetailURI('contactgroup', contactgroup.pk))
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.content)
+
+        self.assertEqual(response['contacts'], [
+            self.resourceDetailURI('individual', individual1.pk),
+            self.resourceDetailURI('company', company.pk),
+            self.resourceDetailURI('individual', individual2.pk),
+        ])
+
     def test_polymorphic_duplicate_class(self):
         with self.assertRaises(exceptions.ImproperlyConfigured):
             class DuplicateSubtypePersonResource(tastypie_mongoengine_resources.MongoEngineResource):
@@ -1188,6 +1573,26 @@ class BasicTest(test_runner.MongoEngineTestCase):
                         'otherstrangeperson': resources.OtherStrangePersonResource,
                     }
 
+    def test_polymorphic_class_maps(self):
+        class SubIndividual(documents.Individual):
+            pass
+
+        resource = resources.ContactResource()
+        type_map = resource._meta.polymorphic
+
+        self.assertEqual(resource._get_type_from_class(type_map, documents.Individual), 'individual')
+        self.assertEqual(resource._get_type_from_class(type_map, documents.UnregisteredCompany), 'unregisteredcompany')
+        self.assertEqual(resource._get_resource_from_class(type_map, documents.Company), resources.CompanyResource)
+
+        # Nearest mapped class is used for subclasses
+        self.assertEqual(resource._get_type_from_class(type_map, SubIndividual), 'individual')
+        self.assertEqual(resource._get_resource_from_class(type_map, SubIndividual), resources.IndividualResource)
+
+        with self.assertRaises(KeyError):
+            resource._get_type_from_class(type_map, documents.Contact)
+        with self.assertRaises(KeyError):
+            resource._get_resource_from_class(type_map, documents.Person)
+
     def test_mapping_boolean_field(self):
         self.assertEqual(resources.BooleanMapTestResource().is_published_auto.default, documents.BooleanMapTest()._fields['is_published_auto'].default)
         self.assertEqual(resources.BooleanMapTestResource().is_published_auto.null, not documents.BooleanMapTest()._fields['is_published_auto'].required)
@@ -1412,6 +1817,303 @@ class BasicTest(test_runner.MongoEngineTestCase):
     def test_pagination(self):
         self._test_pagination(self.resourceListURI('person'), 'name', 'Person %s')
 
+    def test_cursor_pagination(self):
+        uri = self.resourceListURI('person')
+
+        for i in range(30):
+            response = self.c.post(uri, '{"name": "Person %s"}' % i, content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+
+        names = sorted(['Person %s' % i for i in range(30)], reverse=True)
+
+        response = self.c.get(uri, {'order_by': '-name', 'limit': 7})
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.content)
+
+        self.assertEqual([obj['name'] for obj in response['objects']], names[0:7])
+
+        offset = response['objects'][0]['id']
+
+        response = self.c.get(uri, {'order_by': '-name', 'offset': offset, 'limit': 7})
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.content)
+
+        self.assertEqual([obj['name'] for obj in response['objects']], names[0:7])
+        self.assertTrue(response['meta']['next'])
+
+        response = self.c.get(response['meta']['next'])
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.content)
+
+        self.assertEqual([obj['name'] for obj in response['objects']], names[7:14])
+        self.assertTrue(response['meta']['previous'])
+
+        previous_uri = response['meta']['previous']
+
+        response = self.c.get(response['meta']['next'])
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.content)
+
+        self.assertEqual([obj['name'] for obj in response['objects']], names[14:21])
+
+        response = self.c.get(previous_uri)
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.content)
+
+        self.assertEqual([obj['name'] for obj in response['objects']], names[0:7])
+
+        response = self.c.get(uri, {'order_by': '-name', 'offset': 7, 'limit': 7})
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.content)
+
+        offset = response['objects'][3]['id']
+
+        # Negative limit walks backwards from the offset
+        response = self.c.get(uri, {'order_by': '-name', 'offset': offset, 'limit': -3})
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.content)
+
+        self.assertEqual([obj['name'] for obj in response['objects']], [names[10], names[9], names[8]])
+
+        # Cursor cannot be used with a different ordering
+        response = self.c.get(previous_uri.replace('order_by=-name', 'order_by=name'))
+        self.assertContains(response, 'Cursor does not match ordering', status_code=400)
+
+        # Cursors are signed
+        response = self.c.get(uri, {'order_by': '-name', 'offset': 'invalid:cursor', 'limit': 7})
+        self.assertContains(response, 'Invalid offset', status_code=400)
+
+    def test_pagination_bookmarks(self):
+        for i in range(50):
+            response = self.c.post(self.resourceListURI('person'), '{"name": "Person %s"}' % i, content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+
+        objects = resources.PersonResource().get_object_list(None)
+        paginator_class = type('BookmarkPaginator', (paginator.Paginator,), {'bookmark_interval': 10})
+
+        def page(offset):
+            return paginator_class({'limit': 5, 'offset': offset}, objects, resource_uri=self.resourceListURI('person')).page()
+
+        for offset in (27, 23, 44, 3, 27):
+            response = page(offset)
+            self.assertEqual([obj.name for obj in response['objects']], ['Person %s' % i for i in range(offset, offset + 5)])
+            self.assertEqual(response['meta']['total_count'], 50)
+
+        documents.Person.objects.filter(name__in=['Person 0', 'Person 1']).delete()
+        paginator.invalidate_bookmarks(documents.Person)
+
+        response = page(27)
+        self.assertEqual([obj.name for obj in response['objects']], ['Person %s' % i for i in range(29, 34)])
+
+    def test_pagination_bookmarks_invalidation(self):
+        for i in range(3):
+            response = self.c.post(self.resourceListURI('person'), '{"name": "Person %s"}' % i, content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+
+        person_uri = self.resourceDetailURI('person', documents.Person.objects.get(name='Person 0').pk)
+        collection_name = documents.Person._get_collection_name()
+
+        paginator_class = resources.PersonResource._meta.paginator_class
+        resources.PersonResource._meta.paginator_class = type('BookmarkPaginator', (paginator.Paginator,), {'bookmark_interval': 10})
+        try:
+            generation = paginator._get_bookmarks_generation(collection_name)
+
+            # Update which does not change anything keeps bookmarks
+            response = self.c.put(person_uri, '{"name": "Person 0"}', content_type='application/json')
+            self.assertEqual(response.status_code, 204)
+            self.assertEqual(paginator._get_bookmarks_generation(collection_name), generation)
+
+            response = self.c.put(person_uri, '{"name": "Person 0", "optional": "Changed"}', content_type='application/json')
+            self.assertEqual(response.status_code, 204)
+            self.assertNotEqual(paginator._get_bookmarks_generation(collection_name), generation)
+
+            generation = paginator._get_bookmarks_generation(collection_name)
+
+            response = self.c.delete(self.resourceListURI('person'))
+            self.assertEqual(response.status_code, 204)
+            self.assertNotEqual(paginator._get_bookmarks_generation(collection_name), generation)
+            self.assertEqual(documents.Person.objects.count(), 0)
+        finally:
+            resources.PersonResource._meta.paginator_class = paginator_class
+
+    def test_count_strategies(self):
+        for i in range(10):
+            response = self.c.post(self.resourceListURI('person'), '{"name": "Person %s"}' % i, content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+
+        objects = resources.PersonResource().get_object_list(None)
+
+        def page(count_strategy, objects, offset=0):
+            paginator_class = type('CountPaginator', (paginator.Paginator,), {'count_strategy': count_strategy, 'count_cap': 5})
+            return paginator_class({'limit': 3, 'offset': offset}, objects, resource_uri=self.resourceListURI('person')).page()['meta']
+
+        meta = page('exact', objects)
+        self.assertEqual(meta['total_count'], 10)
+        self.assertEqual(meta['total_count_strategy'], 'exact')
+
+        meta = page('estimated', objects)
+        self.assertEqual(meta['total_count'], 10)
+        self.assertEqual(meta['total_count_strategy'], 'estimated')
+
+        meta = page('estimated', objects.filter(name='Person 1'))
+        self.assertEqual(meta['total_count'], 1)
+        self.assertEqual(meta['total_count_strategy'], 'exact')
+
+        meta = page('capped', objects, offset=6)
+        self.assertEqual(meta['total_count'], 5)
+        self.assertEqual(meta['total_count_strategy'], 'capped')
+        self.assertTrue(meta['next'])
+
+        meta = page('capped', objects.filter(name='Person 1'))
+        self.assertEqual(meta['total_count'], 1)
+        self.assertEqual(meta['total_count_strategy'], 'exact')
+
+        meta = page('disabled', objects, offset=6)
+        self.assertEqual(meta['total_count'], None)
+        self.assertEqual(meta['total_count_strategy'], 'disabled')
+        self.assertTrue(meta['next'])
+
+        meta = page('disabled', objects, offset=9)
+        self.assertEqual(meta['next'], None)
+
+    def test_facet_page(self):
+        for i in range(10):
+            response = self.c.post(self.resourceListURI('person'), '{"name": "Person %s", "optional": "Optional %s"}' % (i, i), content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+
+        objects = resources.PersonResource().get_object_list(None).order_by('name')
+        paginator_class = type('FacetPaginator', (paginator.Paginator,), {'use_facet': True})
+
+        def page(objects, offset=0):
+            return paginator_class({'limit': 3, 'offset': offset}, objects, resource_uri=self.resourceListURI('person')).page()
+
+        response = page(objects, offset=6)
+        self.assertEqual([obj.name for obj in response['objects']], ['Person 6', 'Person 7', 'Person 8'])
+        self.assertEqual([obj.optional for obj in response['objects']], ['Optional 6', 'Optional 7', 'Optional 8'])
+        self.assertEqual(response['meta']['total_count'], 10)
+        self.assertEqual(response['meta']['total_count_strategy'], 'exact')
+
+        response = page(objects.filter(name__in=['Person 1', 'Person 2']))
+        self.assertEqual([obj.name for obj in response['objects']], ['Person 1', 'Person 2'])
+        self.assertEqual(response['meta']['total_count'], 2)
+
+        # Projection of the queryset is applied
+        response = page(objects.only('name'), offset=6)
+        self.assertEqual([obj.name for obj in response['objects']], ['Person 6', 'Person 7', 'Person 8'])
+        self.assertEqual([obj.optional for obj in response['objects']], [None, None, None])
+        self.assertEqual(response['meta']['total_count'], 10)
+
+        # Querysets with their own skip or limit are paginated without $facet
+        limited = objects.limit(5)
+        self.assertEqual(paginator_class({'limit': 3, 'offset': 3}, limited, resource_uri=self.resourceListURI('person'))._get_facet_page(3, 3), None)
+
+    def test_listqueryset_filter(self):
+        object_list = tastypie_mongoengine_resources.ListQuerySet([(unicode(i), documents.EmbeddedPerson(name='Person %s' % (i % 5), optional='%02d' % i)) for i in range(20)])
+
+        result = object_list.filter(name='Person 3')
+        self.assertEqual(result.keys(), [u'3', u'8', u'13', u'18'])
+
+        result = object_list.filter(name__exact='Person 3', optional__gte='13')
+        self.assertEqual(result.keys(), [u'13', u'18'])
+
+        result = object_list.filter(name__lt='Person 2', pk=u'10')
+        self.assertEqual(result.keys(), [u'10'])
+
+        result = object_list.filter(name__gt='Person 9')
+        self.assertEqual(result.keys(), [])
+
+        # Indexes are reused by later filters
+        self.assertTrue('name' in object_list._hash_indexes)
+        self.assertTrue('name' in object_list._sorted_indexes)
+
+        result = object_list.filter(name__in=['Person 1', 'Person 2'])
+        self.assertEqual(result.keys(), [u'1', u'2', u'6', u'7', u'11', u'12', u'16', u'17'])
+
+        result = object_list.filter(optional__startswith='1', name__ne='Person 0')
+        self.assertEqual(result.keys(), [u'11', u'12', u'13', u'14', u'16', u'17', u'18', u'19'])
+
+        result = object_list.filter(name__icontains='PERSON 4')
+        self.assertEqual(result.keys(), [u'4', u'9', u'14', u'19'])
+
+        result = object_list.filter(hidden__exists=False)
+        self.assertEqual(len(result), 20)
+
+        result = object_list.filter(hidden__exists=True)
+        self.assertEqual(len(result), 0)
+
+        result = object_list.filter(name__not__startswith='Person')
+        self.assertEqual(len(result), 0)
+
+        with self.assertRaises(tastypie_exceptions.InvalidFilterError):
+            object_list.filter(nonexistent='Person 3')
+
+        with self.assertRaises(tastypie_exceptions.InvalidFilterError):
+            object_list.filter(name__near='Person 3')
+
+        object_list = tastypie_mongoengine_resources.ListQuerySet([(unicode(i), documents.DatetimeFieldTest(datetime=datetime.datetime(2012, 12, 12 + i))) for i in range(3)])
+
+        result = object_list.filter(datetime__gt='2012-12-13T00:00:00')
+        self.assertEqual(result.keys(), [u'2'])
+
+        with self.assertRaises(tastypie_exceptions.InvalidFilterError):
+            object_list.filter(datetime__gt='garbage')
+
+    def test_listqueryset_order_by(self):
+        object_list = tastypie_mongoengine_resources.ListQuerySet([(unicode(i), documents.EmbeddedPerson(name='Person %s' % (i % 3), optional='%02d' % (i % 2))) for i in range(6)])
+
+        result = object_list.order_by('name', '-optional')
+        self.assertEqual(result.keys(), [u'3', u'0', u'1', u'4', u'5', u'2'])
+
+        result = object_list.order_by('-name', 'optional')
+        self.assertEqual(result.keys(), [u'2', u'5', u'4', u'1', u'0', u'3'])
+
+        with self.assertRaises(tastypie_exceptions.InvalidSortError):
+            object_list.order_by('nonexistent')
+
+    def test_listqueryset_indexing(self):
+        object_list = tastypie_mongoengine_resources.ListQuerySet([(unicode(i), documents.EmbeddedPerson(name='Person %s' % i)) for i in range(6)])
+
+        self.assertEqual(len(object_list), 6)
+        self.assertEqual(object_list[3].name, 'Person 3')
+        self.assertEqual(object_list[-1].name, 'Person 5')
+        self.assertEqual([obj.name for obj in object_list[2:4]], ['Person 2', 'Person 3'])
+        self.assertEqual([obj.name for obj in reversed(object_list)][0], 'Person 5')
+        self.assertEqual(object_list[u'4'].name, 'Person 4')
+
+        object_list.pop(u'1')
+        self.assertEqual(len(object_list), 5)
+        self.assertEqual(object_list[1].name, 'Person 2')
+        self.assertEqual(object_list[u'4'].name, 'Person 4')
+        self.assertEqual(object_list.keys(), [u'0', u'2', u'3', u'4', u'5'])
+
+        with self.assertRaises(KeyError):
+            object_list[u'1']
+
+    def test_aggregated_listqueryset_paginator(self):
+        embeddedlistfieldtest = documents.EmbeddedListFieldTest(embeddedlist=[documents.EmbeddedPerson(name='Embedded person 1')])
+        objects = tastypie_mongoengine_resources.AggregatedListQuerySet(embeddedlistfieldtest, 'embeddedlist', ordering=[('embeddedlist.name', 1)])
+
+        # Aggregated list is paginated as a list, not as a MongoEngine queryset
+        p = paginator.Paginator({}, objects)
+        self.assertFalse(p._is_queryset())
+        self.assertEqual(p._get_ordering(), None)
+
+    def test_embedded_listqueryset(self):
+        documents_list = [documents.EmbeddedPerson(name='Person %s' % i) for i in range(6)]
+        object_list = tastypie_mongoengine_resources.EmbeddedListQuerySet(documents_list)
+
+        self.assertEqual(len(object_list), 6)
+        self.assertEqual(object_list[3].pk, 3)
+        self.assertEqual([obj.pk for obj in object_list[4:]], [4, 5])
+        self.assertEqual(object_list[u'2'].name, 'Person 2')
+        self.assertEqual(object_list.filter(pk=u'1')[0].name, 'Person 1')
+        self.assertEqual(len(object_list.filter(pk=u'01')), 0)
+        self.assertFalse(object_list._is_materialized())
+
+        self.assertEqual(object_list.filter(name='Person 5').keys(), [u'5'])
+        self.assertTrue(object_list._is_materialized())
+        self.assertEqual([obj.pk for obj in object_list], range(6))
+
     def test_embedded_in_embedded_doc(self):
         post = """
         {
@@ -1494,6 +2196,28 @@ class BasicTest(test_runner.MongoEngineTestCase):
 
         self._test_pagination(document_uri + 'comments/', 'content', 'Comment %s')
 
+    def test_find_embedded_document(self):
+        resource = resources.DocumentWithIDResource().fields['comments'].to_class()
+        comments = [documents.EmbeddedCommentWithID(content='Comment %s' % i) for i in range(4)]
+
+        self.assertEqual(resource.find_embedded_document(comments, 'id', comments[2].id), 2)
+
+        comments.pop(0)
+        self.assertEqual(resource.find_embedded_document(comments, 'id', comments[2].id), 2)
+
+        # Changed in place, with the same length, which is noticed on a stale hit
+        replaced = comments[1]
+        comments[1] = documents.EmbeddedCommentWithID(content='Replaced')
+        with self.assertRaises(IndexError):
+            resource.find_embedded_document(comments, 'id', replaced.id)
+        self.assertEqual(resource.find_embedded_document(comments, 'id', comments[1].id), 1)
+
+        # Keys are compared as strings
+        self.assertEqual(resource.find_embedded_document(comments, 'id', unicode(comments[2].id)), 2)
+
+        with self.assertRaises(IndexError):
+            resource.find_embedded_document(comments, 'id', documents.EmbeddedCommentWithID().id)
+
     def test_embeddedlist_referencefield(self):
         response = self.c.post(self.resourceListURI('exporters'), '{"name": "exporter_1"}', content_type='application/json')
         self.assertEqual(response.status_code, 201)
@@ -1599,3 +2323,140 @@ class BasicTest(test_runner.MongoEngineTestCase):
         response = json.loads(response.content)
 
         self.assertEqual(response['datetime'], '2012-12-12T12:00:00')
+
+    def test_atomic_patch(self):
+        response = self.c.post(self.resourceListURI('datetimefieldtest'), '{"datetime": "2012-12-12T12:12:12"}', content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+        datetimefieldtest_uri = response['location']
+
+        reads = []
+        find = pymongo_collection.Collection.find
+
+        def counted_find(*args, **kwargs):
+            reads.append(1)
+            return find(*args, **kwargs)
+
+        resources.DatetimeFieldTestResource._meta.atomic_patch = True
+        try:
+            # The document is updated without being read
+            pymongo_collection.Collection.find = counted_find
+            try:
+                response = self.c.patch(datetimefieldtest_uri, '{"datetime": "2012-12-12T12:30:00"}', content_type='application/json')
+            finally:
+                pymongo_collection.Collection.find = find
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(len(reads), 0)
+
+            # Updated document is returned
+            resources.DatetimeFieldTestResource._meta.always_return_data = True
+            try:
+                response = self.c.patch(datetimefieldtest_uri, '{"datetime": "2012-12-12T12:00:00"}', content_type='application/json')
+            finally:
+                del resources.DatetimeFieldTestResource._meta.always_return_data
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(json.loads(response.content)['datetime'], '2012-12-12T12:00:00')
+            self.assertEqual(json.loads(response.content)['resource_uri'], self.fullURItoAbsoluteURI(datetimefieldtest_uri))
+
+            response = self.c.patch(datetimefieldtest_uri, '{"datetime": null}', content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+            response = self.c.patch(self.resourceDetailURI('datetimefieldtest', '4fb88d7549902817fe000000'), '{"datetime": "2012-12-12T12:00:00"}', content_type='application/json')
+            self.assertEqual(response.status_code, 404)
+
+            class NoUpdateAuthorization(tastypie_authorization.Authorization):
+                def update_list(self, object_list, bundle):
+                    return object_list.filter(pk__in=[])
+
+            class OwnerAuthorization(tastypie_authorization.Authorization):
+                def update_detail(self, object_list, bundle):
+                    return False
+
+            authorization = resources.DatetimeFieldTestResource._meta.authorization
+            try:
+                # Documents which cannot be updated are not found
+                resources.DatetimeFieldTestResource._meta.authorization = NoUpdateAuthorization()
+                response = self.c.patch(datetimefieldtest_uri, '{"datetime": "2012-12-12T13:00:00"}', content_type='application/json')
+                self.assertEqual(response.status_code, 404)
+
+                # Authorization which needs the stored document is not used without it
+                resources.DatetimeFieldTestResource._meta.authorization = OwnerAuthorization()
+                self.assertFalse(resources.DatetimeFieldTestResource()._can_authorize_atomic_update())
+                response = self.c.patch(datetimefieldtest_uri, '{"datetime": "2012-12-12T13:00:00"}', content_type='application/json')
+                self.assertEqual(response.status_code, 401)
+            finally:
+                resources.DatetimeFieldTestResource._meta.authorization = authorization
+        finally:
+            del resources.DatetimeFieldTestResource._meta.atomic_patch
+
+        response = self.c.get(datetimefieldtest_uri)
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.content)
+
+        self.assertEqual(response['datetime'], '2012-12-12T12:00:00')
+
+        # Documents with custom save method are saved with it
+        response = self.c.post(self.resourceListURI('autoallocationfieldtest'), '{"name": "Auto slug test"}', content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+        autoallocationfieldtest_uri = response['location']
+
+        resources.AutoAllocationFieldTestResource._meta.atomic_patch = True
+        try:
+            pymongo_collection.Collection.find = counted_find
+            try:
+                response = self.c.patch(autoallocationfieldtest_uri, '{"name": "Auto slug test 2"}', content_type='application/json')
+            finally:
+                pymongo_collection.Collection.find = find
+            self.assertEqual(response.status_code, 202)
+            self.assertTrue(reads)
+        finally:
+            del resources.AutoAllocationFieldTestResource._meta.atomic_patch
+
+        self.assertEqual(documents.AutoAllocationFieldTest.objects.get(pk=self.resourcePK(self.fullURItoAbsoluteURI(autoallocationfieldtest_uri))).name, 'Auto slug test 2')
+
+        # Embedded fields are not updated atomically
+        resource = resources.EmbeddedDocumentFieldTestResource()
+        self.assertEqual(resource._get_atomic_update(resource.build_bundle(data={'customer': {'name': 'Embedded person 1'}})), None)
+        resource = resources.EmbeddedListFieldTestResource()
+        self.assertEqual(resource._get_atomic_update(resource.build_bundle(data={'embeddedlist': [{'name': 'Embedded person 1'}]})), None)
+
+    def test_changed_fields(self):
+        documents.Person(name='Person 1', optional='Optional').save()
+
+        person = documents.Person.objects.get(name='Person 1')
+        original = person.to_mongo()
+        person.name = 'Person 1'
+        person.optional = 'Changed'
+
+        self.assertEqual(resources.PersonResource()._mark_changed_fields(person, original), ['optional'])
+        self.assertEqual(person._delta(), ({'optional': 'Changed'}, {}))
+
+        person.optional = 'Optional'
+        self.assertEqual(resources.PersonResource()._mark_changed_fields(person, original), [])
+        self.assertEqual(person._delta(), ({}, {}))
+
+        # Update which does not change anything is not sent to the database
+        collection = documents.Person._get_collection()
+        stored = collection.find_one({'_id': person.pk})
+
+        writes = []
+        methods = dict((name, getattr(pymongo_collection.Collection, name)) for name in ('update', 'update_one', 'replace_one', 'save') if hasattr(pymongo_collection.Collection, name))
+
+        def counted(method):
+            def counted_method(*args, **kwargs):
+                writes.append(1)
+                return method(*args, **kwargs)
+            return counted_method
+
+        for name, method in methods.iteritems():
+            setattr(pymongo_collection.Collection, name, counted(method))
+        try:
+            response = self.c.put(self.resourceDetailURI('person', person.pk), '{"name": "Person 1", "optional": "Optional"}', content_type='application/json')
+        finally:
+            for name, method in methods.iteritems():
+                setattr(pymongo_collection.Collection, name, method)
+        self.assertEqual(response.status_code, 204)
+
+        self.assertEqual(writes, [])
+        self.assertEqual(collection.find_one({'_id': person.pk}), stored)
@@ -15,12 +15,14 @@ v1_api.register(resources.ContactGroupResource())
 v1_api.register(resources.CustomerResource())
 v1_api.register(resources.BoardResource())
 v1_api.register(resources.DocumentWithIDResource())
+v1_api.register(resources.EmbeddedListWithIDFieldTestResource())
 v1_api.register(resources.EmbeddedListInEmbeddedDocTestResource())
 v1_api.register(resources.EmbeddedDocumentFieldTestResource())
 v1_api.register(resources.DictFieldTestResource())
 v1_api.register(resources.ListFieldTestResource())
 v1_api.register(resources.EmbeddedListFieldTestResource())
 v1_api.register(resources.EmbeddedListFieldNonFullTestResource())
+v1_api.register(resources.EmbeddedListFieldAggregatedTestResource())
 v1_api.register(resources.ReferencedListFieldTestResource())
 v1_api.register(resources.ReferencedListFieldNonFullTestResource())
 v1_api.register(resources.BooleanMapTestResource())